@@ -2,10 +2,12 @@
 import gspread
 import logging
 
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 # Telegram
-from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram import Bot, Update
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, TypeHandler, ContextTypes, filters, ApplicationHandlerStop
+from telegram.ext import BaseUpdateProcessor
+from telegram.error import RetryAfter, TimedOut, NetworkError
 from telegram.ext import CommandHandler
 from telegram import ReplyKeyboardMarkup
 
@@ -19,12 +21,115 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from pytz import timezone
 import asyncio
 import os
+import json
+import threading
+import functools
+import io
+import zlib
+import hmac
+import sys
+import uuid
+import unicodedata
+import csv
+import hashlib
+import re
+import random
+import bisect
+import sqlite3
+import signal
+import queue
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from time import monotonic
+import time as _time
 
 from gspread_formatting import set_frozen
-from gspread.exceptions import APIError
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import ValueRenderOption, rowcol_to_a1
+
+from PIL import Image, ImageOps
+import numpy as np
 
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.errors import HttpError
+
+# Configuración de Google (mismos nombres de variables que la web)
+CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE", "credentials.json")
+GOOGLE_SCOPES = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+USERS_SHEET_NAME = os.getenv("GOOGLE_USERS_SHEET_NAME", "Users")
+QUESTIONS_SHEET_NAME = os.getenv("GOOGLE_QUESTIONS_SHEET_NAME", "Preguntas")
+REVISION_SHEET_NAME = os.getenv("GOOGLE_REVISION_SHEET_NAME", "Revisiones")
+REVISION_WORKSHEET_NAME = os.getenv("GOOGLE_REVISION_WORKSHEET_NAME", "Revision")
+# Formato de las revisiones: "long" (una fila por respuesta) o "wide" (una fila por revisión, en su propia pestaña)
+REVISION_FORMAT = os.getenv("BOT_REVISION_FORMAT", "long")
+WIDE_REVISION_WORKSHEET_NAME = os.getenv("GOOGLE_WIDE_REVISION_WORKSHEET_NAME", "RevisionPorFila")
+DRIVE_ROOT_FOLDER_ID = os.getenv("GOOGLE_DRIVE_ROOT_FOLDER_ID", "1G-QgvfDD-dqMPzjuaA71ii7t6aWn_prX")
+
+# Configuración del bot
+# Obligatorio: el token de @BotFather no se guarda en el código
+BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+# "polling" (por defecto) o "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("BOT_WEBHOOK_WORKERS", "1"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("BOT_WEBHOOK_QUEUE_SIZE", "1000"))
+# Métricas de Prometheus en http://BOT_METRICS_HOST:BOT_METRICS_PORT/metrics (0 para desactivarlas)
+METRICS_HOST = os.getenv("BOT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "9108"))
+USERS_TTL_SECONDS = int(os.getenv("BOT_USERS_TTL_SECONDS", "300"))
+BOT_ADMINS = {u.strip() for u in os.getenv("BOT_ADMINS", "").split(",") if u.strip()}
+DATA_DIR = os.getenv("BOT_DATA_DIR", "data")
+JOURNAL_FLUSH_SECONDS = float(os.getenv("BOT_JOURNAL_FLUSH_SECONDS", "5"))
+JOURNAL_BATCH_ROWS = int(os.getenv("BOT_JOURNAL_BATCH_ROWS", "500"))
+SHEETS_CONCURRENCY = int(os.getenv("BOT_SHEETS_CONCURRENCY", "4"))
+DRIVE_CONCURRENCY = int(os.getenv("BOT_DRIVE_CONCURRENCY", "4"))
+# Cupo de peticiones por minuto a cada API de Google y reintentos ante 429/5xx (backoff exponencial con jitter)
+SHEETS_RATE_PER_MINUTE = float(os.getenv("BOT_SHEETS_RATE_PER_MINUTE", "60"))
+DRIVE_RATE_PER_MINUTE = float(os.getenv("BOT_DRIVE_RATE_PER_MINUTE", "600"))
+GOOGLE_MAX_RETRIES = int(os.getenv("BOT_GOOGLE_MAX_RETRIES", "5"))
+GOOGLE_BACKOFF_SECONDS = float(os.getenv("BOT_GOOGLE_BACKOFF_SECONDS", "1"))
+GOOGLE_BACKOFF_MAX_SECONDS = float(os.getenv("BOT_GOOGLE_BACKOFF_MAX_SECONDS", "32"))
+# Normalización de fotos: lado máximo y calidad JPEG de la imagen y de su miniatura
+IMAGE_MAX_SIDE = int(os.getenv("BOT_IMAGE_MAX_SIDE", "2560"))
+IMAGE_QUALITY = int(os.getenv("BOT_IMAGE_QUALITY", "85"))
+THUMBNAIL_SIDE = int(os.getenv("BOT_THUMBNAIL_SIDE", "400"))
+THUMBNAIL_QUALITY = int(os.getenv("BOT_THUMBNAIL_QUALITY", "75"))
+IMAGE_WORKERS = int(os.getenv("BOT_IMAGE_WORKERS", "2"))
+# Tamaño de cada trozo de la subida reanudable (múltiplo de 256 KB)
+UPLOAD_CHUNK_BYTES = int(os.getenv("BOT_UPLOAD_CHUNK_BYTES", str(1024 * 1024)))
+# Espera tras la última foto de un álbum antes de procesarlo, y subidas simultáneas por álbum
+ALBUM_WAIT_SECONDS = float(os.getenv("BOT_ALBUM_WAIT_SECONDS", "1.5"))
+ALBUM_UPLOAD_CONCURRENCY = int(os.getenv("BOT_ALBUM_UPLOAD_CONCURRENCY", "4"))
+# Envío semanal: zona horaria de las 10:00, límites de Telegram (mensajes/s) y ventana de reparto
+BOT_TIMEZONE = timezone(os.getenv("BOT_TIMEZONE", "UTC"))
+BROADCAST_GLOBAL_RATE = float(os.getenv("BOT_BROADCAST_RATE", "25"))
+BROADCAST_CHAT_RATE = float(os.getenv("BOT_BROADCAST_CHAT_RATE", "1"))
+BROADCAST_WINDOW_SECONDS = float(os.getenv("BOT_BROADCAST_WINDOW_SECONDS", "600"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BOT_BROADCAST_MAX_RETRIES", "3"))
+# Sesiones sin actividad durante este tiempo salen de memoria (siguen en SQLite)
+SESSION_IDLE_SECONDS = int(os.getenv("BOT_SESSION_IDLE_SECONDS", "1800"))
+# update_id recientes que se recuerdan en memoria y tiempo que se guardan en disco (Telegram reintenta hasta 24 h)
+SEEN_UPDATES_MEMORY = int(os.getenv("BOT_SEEN_UPDATES_MEMORY", "10000"))
+SEEN_UPDATES_RETENTION_SECONDS = int(os.getenv("BOT_SEEN_UPDATES_RETENTION_SECONDS", str(48 * 3600)))
+# Updates procesados a la vez (de usuarios distintos) y updates que puede tener en espera un mismo usuario
+UPDATES_MAX_IN_FLIGHT = int(os.getenv("BOT_UPDATES_MAX_IN_FLIGHT", "32"))
+UPDATES_MAX_PENDING_PER_USER = int(os.getenv("BOT_UPDATES_MAX_PENDING_PER_USER", "20"))
+# Cada cuánto se mira si ha cambiado la hoja `Preguntas`
+QUESTIONS_CHECK_SECONDS = int(os.getenv("BOT_QUESTIONS_CHECK_SECONDS", "60"))
+# Espejo local de `Revisiones` y `Users`: antigüedad máxima y filas por lectura de rango
+MIRROR_SYNC_SECONDS = int(os.getenv("BOT_MIRROR_SYNC_SECONDS", "30"))
+MIRROR_CHUNK_ROWS = int(os.getenv("BOT_MIRROR_CHUNK_ROWS", "5000"))
+# Filas ya copiadas que se vuelven a leer en formato ancho: las fotos llegan después que las respuestas
+MIRROR_RECHECK_ROWS = int(os.getenv("BOT_MIRROR_RECHECK_ROWS", "200"))
+# /progreso: semanas de la media móvil y de la recta de tendencia
+PROGRESS_ROLLING_WEEKS = int(os.getenv("BOT_PROGRESS_ROLLING_WEEKS", "4"))
+PROGRESS_TREND_WEEKS = int(os.getenv("BOT_PROGRESS_TREND_WEEKS", "8"))
 
 @dataclass
 class User:
@@ -32,94 +137,803 @@ class User:
     telegram_id: str
 
 
-# Global variables
-ActiveUsers = {}
-Questions = {}
-user_data = {}
+class GoogleClients:
+    """Clientes de Google compartidos por todo el proceso.
+
+    Se construyen una sola vez al arrancar. Las credenciales de google-auth
+    renuevan el token solas cuando caduca y tanto gspread (requests.Session)
+    como el servicio de Drive reutilizan sus conexiones HTTP, así que un
+    mensaje normal no paga ninguna autenticación.
+
+    Crearlos no hace ninguna petición: cada hoja se abre la primera vez que
+    se usa, de modo que el bot arranca (con el espejo local) aunque Sheets no
+    responda en ese momento.
+    """
+
+    def __init__(self, credentials_file=CREDENTIALS_FILE):
+        self.creds = Credentials.from_service_account_file(credentials_file, scopes=GOOGLE_SCOPES)
+        self.gc = gspread.authorize(self.creds)
+
+        # Hojas que usa el bot, abiertas una única vez (si falla se reintenta en el siguiente uso)
+        self._worksheets = {}
+        self._open_lock = threading.RLock()
+
+        # httplib2 no es thread-safe: un servicio de Drive por hilo del pool
+        self._local = threading.local()
+
+    def _worksheet(self, key, opener):
+        with self._open_lock:
+            sheet = self._worksheets.get(key)
+            if sheet is None:
+                sheet = self._worksheets[key] = opener()
+            return sheet
+
+    @property
+    def users_ws(self):
+        return self._worksheet("users", lambda: self.gc.open(USERS_SHEET_NAME).sheet1)
+
+    @property
+    def questions_ws(self):
+        return self._worksheet("questions", lambda: self.gc.open(QUESTIONS_SHEET_NAME).sheet1)
+
+    @property
+    def revision_ws(self):
+        return self._worksheet("revision", lambda: self.gc.open(REVISION_SHEET_NAME).worksheet(REVISION_WORKSHEET_NAME))
+
+    @property
+    def wide_revision_ws(self):
+        """Pestaña del formato ancho, en el mismo documento que `Revisiones`. Se crea si no existe."""
+        def open_wide():
+            spreadsheet = self.revision_ws.spreadsheet
+            try:
+                return spreadsheet.worksheet(WIDE_REVISION_WORKSHEET_NAME)
+            except WorksheetNotFound:
+                return spreadsheet.add_worksheet(WIDE_REVISION_WORKSHEET_NAME, rows=1000, cols=40)
+        return self._worksheet("wide_revision", open_wide)
+
+    def current_revision_ws(self):
+        """La pestaña donde se escriben las revisiones nuevas según BOT_REVISION_FORMAT."""
+        return self.wide_revision_ws if REVISION_FORMAT == "wide" else self.revision_ws
+
+    @property
+    def drive(self):
+        service = getattr(self._local, "drive", None)
+        if service is None:
+            service = build('drive', 'v3', credentials=self.creds, cache_discovery=False)
+            self._local.drive = service
+        return service
+
+
+class Metrics:
+    """Métricas del bot en memoria, servidas en formato de texto de Prometheus.
+
+    Histogramas de latencia (handlers y llamadas a Google), contadores de
+    errores y gauges que se calculan en el momento de leerlos (colas,
+    sesiones). Se puede observar desde cualquier hilo.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    HELP = {
+        "bot_handler_seconds": "Duración de cada handler de Telegram.",
+        "bot_handler_errors_total": "Excepciones salidas de cada handler.",
+        "bot_google_call_seconds": "Duración de cada llamada a la API de Google por operación.",
+        "bot_google_errors_total": "Llamadas a la API de Google que han fallado por operación.",
+        "bot_google_retries_total": "Reintentos de llamadas a Google tras un 429 o un 5xx.",
+        "bot_google_coalesced_total": "Lecturas a Google resueltas con una petición idéntica ya en curso.",
+        "bot_duplicate_updates_total": "Updates de Telegram descartados por estar ya procesados.",
+        "bot_duplicate_photos_total": "Fotos no subidas porque ya estaban en Drive.",
+        "bot_updates_dropped_total": "Updates descartados por superar el máximo en espera de un usuario.",
+    }
 
-async def send_questions_to_user(user, update, context, preguntas):
-    try:
-        # Enviar un mensaje de saludo primero
-        await context.bot.send_message(
-            chat_id=update.message.chat_id,
-            text=f"¡Hola {user.nombre}! 👋\n\nComencemos con unas preguntas de seguimiento:"
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # nombre -> {etiquetas: [cuentas por bucket..., suma, total]}
+        self._counters = {}
+        self._gauges = {}
+        self._help = dict(self.HELP)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            data = series.get(key)
+            if data is None:
+                data = series[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            index = bisect.bisect_left(self.BUCKETS, value)
+            if index < len(self.BUCKETS):
+                data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def gauge(self, name, fn, help_text):
+        """Registra un gauge cuyo valor se obtiene llamando a `fn()` al leerlo."""
+        self._gauges[name] = fn
+        self._help[name] = help_text
+
+    def histogram_summary(self, name):
+        """{etiquetas: (total, media, p50, p99)} con los percentiles acotados por el bucket."""
+        with self._lock:
+            series = {key: list(data) for key, data in self._histograms.get(name, {}).items()}
+        summary = {}
+        for key, data in series.items():
+            total = data[-1]
+            summary[key] = (total, data[-2] / total if total else 0.0,
+                            self._quantile(data, 0.5), self._quantile(data, 0.99))
+        return summary
+
+    def _quantile(self, data, q):
+        target = q * data[-1]
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, data):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self._counters.get(name, {}).get(self._key(labels), 0)
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = {name: {k: list(v) for k, v in series.items()} for name, series in self._histograms.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+
+        for name, series in sorted(histograms.items()):
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, data in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, data):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(key, [('le', '+Inf')])} {data[-1]}")
+                lines.append(f"{name}_sum{self._labels(key)} {data[-2]}")
+                lines.append(f"{name}_count{self._labels(key)} {data[-1]}")
+
+        for name, series in sorted(counters.items()):
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{self._labels(key)} {value}")
+
+        for name, fn in sorted(self._gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            lines.append(f"# HELP {name} {self._help.get(name, name)}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def instrumented(name):
+    """Decorador que mide la duración (y los errores) de un handler de Telegram."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            start = monotonic()
+            try:
+                return await handler(update, context)
+            except Exception:
+                metrics.inc("bot_handler_errors_total", handler=name)
+                raise
+            finally:
+                metrics.observe("bot_handler_seconds", monotonic() - start, handler=name)
+        return wrapper
+    return decorator
+
+
+class TokenBucket:
+    """Cubo de tokens asíncrono: `rate` tokens por segundo con ráfagas de hasta `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def charge(self, tokens):
+        """Descuenta tokens ya gastados sin esperar: el saldo puede quedar en negativo."""
+        if tokens > 0:
+            self._tokens -= tokens
+
+
+def google_error_status(error):
+    """Código HTTP de un error de gspread o de googleapiclient (None si no es de la API)."""
+    if isinstance(error, APIError):
+        return getattr(error.response, "status_code", None)
+    if isinstance(error, HttpError):
+        return int(error.resp.status)
+    return None
+
+
+class GoogleIO:
+    """Planificador de la E/S bloqueante de Google (gspread y Drive).
+
+    Las llamadas se ejecutan en un pool de hilos acotado, con un límite de
+    concurrencia y un cubo de tokens (peticiones por minuto) independiente
+    para Sheets y para Drive, de modo que una subida lenta no detiene el
+    resto de updates y una ráfaga de atletas no agota la cuota. Los 429 y
+    5xx se reintentan con backoff exponencial con jitter, y las lecturas
+    idénticas que coinciden en el tiempo comparten una sola petición.
+    """
+
+    # Lecturas: se pueden agrupar y reintentar siempre
+    READ_OPS = {"sheet_read", "drive_list", "drive_metadata"}
+    # Un 5xx puede llegar después de que la operación se hiciera (filas añadidas,
+    # ficheros o carpetas creados en Drive): en estas solo se reintenta el 429
+    NON_IDEMPOTENT_OPS = {"sheet_append", "drive_create", "drive_folder"}
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, sheets_limit=SHEETS_CONCURRENCY, drive_limit=DRIVE_CONCURRENCY,
+                 sheets_rate=None, drive_rate=None, max_retries=GOOGLE_MAX_RETRIES,
+                 backoff=GOOGLE_BACKOFF_SECONDS, backoff_max=GOOGLE_BACKOFF_MAX_SECONDS):
+        # Con varios workers de webhook la cuota del proyecto se reparte entre ellos
+        workers = WEBHOOK_WORKERS if BOT_MODE == "webhook" else 1
+        sheets_rate = (sheets_rate if sheets_rate is not None else SHEETS_RATE_PER_MINUTE / workers) / 60
+        drive_rate = (drive_rate if drive_rate is not None else DRIVE_RATE_PER_MINUTE / workers) / 60
+        self._executor = ThreadPoolExecutor(max_workers=sheets_limit + drive_limit, thread_name_prefix="google-io")
+        self._sheets = asyncio.Semaphore(sheets_limit)
+        self._drive = asyncio.Semaphore(drive_limit)
+        # Ráfagas de hasta 10 s de cupo
+        self._buckets = {
+            "sheets": TokenBucket(sheets_rate, capacity=max(1.0, sheets_rate * 10)),
+            "drive": TokenBucket(drive_rate, capacity=max(1.0, drive_rate * 10)),
+        }
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._inflight = {}
+
+    def _retryable(self, op, error):
+        status = google_error_status(error)
+        if op in self.NON_IDEMPOTENT_OPS:
+            return status == 429
+        return status in self.RETRY_STATUSES
+
+    def _delay(self, attempt):
+        # "Full jitter": espera aleatoria hasta el tope exponencial
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    async def _run(self, semaphore, api, op, fn):
+        def call():
+            # Se mide dentro del hilo: solo la llamada, sin la espera en el pool
+            start = monotonic()
+            try:
+                return fn()
+            except Exception:
+                metrics.inc("bot_google_errors_total", api=api, op=op)
+                raise
+            finally:
+                metrics.observe("bot_google_call_seconds", monotonic() - start, api=api, op=op)
+
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await self._buckets[api].acquire()
+            try:
+                async with semaphore:
+                    return await loop.run_in_executor(self._executor, call)
+            except Exception as e:
+                if attempt == self.max_retries or not self._retryable(op, e):
+                    raise
+                delay = self._delay(attempt)
+                metrics.inc("bot_google_retries_total", api=api, op=op)
+                logging.info(f"Google {api}/{op} respondió {google_error_status(e)}, reintento {attempt + 1} en {delay:.1f}s")
+            # El backoff espera en el bucle, sin ocupar un hilo ni el semáforo
+            await asyncio.sleep(delay)
+
+    async def _schedule(self, semaphore, api, op, fn, key):
+        if op not in self.READ_OPS:
+            return await self._run(semaphore, api, op, fn)
+        try:
+            hash(key)
+        except TypeError:
+            return await self._run(semaphore, api, op, fn)
+
+        # Misma lectura ya en curso: se espera a su resultado en vez de repetirla
+        future = self._inflight.get(key)
+        if future is not None:
+            metrics.inc("bot_google_coalesced_total", api=api, op=op)
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(self._run(semaphore, api, op, fn))
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def sheets(self, op, fn, *args, **kwargs):
+        """Ejecuta `fn(*args)`; `op` es la operación para las métricas (sheet_read, sheet_append...)."""
+        key = ("sheets", op, fn, args, tuple(sorted(kwargs.items())))
+        return await self._schedule(self._sheets, "sheets", op, functools.partial(fn, *args, **kwargs), key)
+
+    async def drive(self, op, fn, *args, **kwargs):
+        """Ejecuta `fn(servicio_drive, *args)` con el servicio del hilo que la atiende."""
+        def call():
+            return fn(google_clients.drive, *args, **kwargs)
+        key = ("drive", op, fn, args, tuple(sorted(kwargs.items())))
+        return await self._schedule(self._drive, "drive", op, call, key)
+
+    async def sheets_calls(self, op, sheet, fn, *args):
+        """Como `sheets`, para una función que hace varias llamadas a través de `sheet` (RevisionSheet).
+
+        `sheets` cobra un token por intento; las demás llamadas que cuente
+        `sheet.calls` se cobran al terminar, para que el cupo refleje la cuota real.
+        """
+        before = sheet.calls
+        attempts = [0]
+
+        def call():
+            attempts[0] += 1
+            return fn(*args)
+
+        try:
+            return await self.sheets(op, call)
+        finally:
+            self._buckets["sheets"].charge(sheet.calls - before - attempts[0])
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class UserDirectory:
+    """Directorio en memoria de usuarios activos indexado por telegram_id.
+
+    La hoja `Users` se lee al arrancar y luego la refresca un job en segundo
+    plano cada TTL; los handlers nunca leen la hoja. Si la lectura falla se
+    sigue sirviendo la última copia buena, y mientras no haya ninguna nadie
+    está habilitado.
+    """
+
+    def __init__(self, loader, ttl=USERS_TTL_SECONDS):
+        self._loader = loader
+        self.ttl = ttl
+        self._by_id = {}
+        self._loaded_at = None
+
+    def refresh(self):
+        try:
+            users = self._loader()
+        except Exception as e:
+            logging.warning(f"No se pudo refrescar la hoja de usuarios, se mantiene la copia anterior: {e}")
+            return False
+        self.load(users)
+        return True
+
+    async def refresh_async(self):
+        """Como `refresh`, pero leyendo la hoja a través de `google_io` (cuota, reintentos)."""
+        try:
+            users = await google_io.sheets("sheet_read", self._loader)
+        except Exception as e:
+            logging.warning(f"No se pudo refrescar la hoja de usuarios, se mantiene la copia anterior: {e}")
+            return False
+        self.load(users)
+        return True
+
+    def load(self, users):
+        # Se sustituye el índice completo de una vez
+        self._by_id = {u.telegram_id: u for u in users}
+        self._loaded_at = monotonic()
+        if sheet_mirror is not None:
+            sheet_mirror.replace_users(users)
+
+    def load_fallback(self, users):
+        """Copia de respaldo mientras no se pueda leer la hoja (no cuenta como carga)."""
+        self._by_id = {u.telegram_id: u for u in users}
+
+    @property
+    def loaded(self):
+        return self._loaded_at is not None
+
+    def get(self, telegram_id):
+        return self._by_id.get(str(telegram_id))
+
+    def all(self):
+        return list(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+class Session:
+    """Estado de conversación de un atleta."""
+
+    __slots__ = ("telegram_id", "name", "step", "current_q", "answers", "question_version", "last_seen")
+
+    def __init__(self, telegram_id, name, step=None, current_q=0, answers=None, question_version=None):
+        self.telegram_id = telegram_id
+        self.name = name
+        self.step = step  # se define cuando inicie el flujo
+        self.current_q = current_q
+        self.answers = answers if answers is not None else []
+        # Versión del cuestionario que está respondiendo el atleta
+        self.question_version = question_version
+        self.last_seen = monotonic()
+
+
+class SessionStore:
+    """Sesiones de conversación persistidas en SQLite (modo WAL).
+
+    Cada respuesta se escribe en cuanto llega, así que un reinicio no pierde
+    cuestionarios a medias. Las sesiones se cargan de disco bajo demanda y
+    las inactivas se expulsan de memoria, que se mantiene plana aunque crezca
+    el número de atletas.
+    """
+
+    def __init__(self, path, idle_seconds=SESSION_IDLE_SECONDS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.idle_seconds = idle_seconds
+        self._cache = OrderedDict()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "telegram_id TEXT PRIMARY KEY, name TEXT, step TEXT, current_q INTEGER, updated_at REAL)"
         )
-        
-        await context.bot.send_message(
-            chat_id=update.message.chat_id,
-            text=f"Empezamos con los perimetros, escribe a continuación en cm las medidas de los siguientes perimetros:"
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "telegram_id TEXT, idx INTEGER, answer TEXT, PRIMARY KEY (telegram_id, idx))"
         )
-        
-        
-        # Es necesario actualizar ele stado de dicho usuario.
-        if user.telegram_id in user_data:
-            user_data[user.telegram_id]["step"] = "ask_questions"
-            
-        else:
-            user_data[user.telegram_id] = {
-                "name": user.nombre,
-                "step": "ask_questions",  # se define cuando inicie el flujo
-                "current_q": 0,
-                "answers": []
-            }
-
-        # Enviar pregunta inicial al usuario
-        await context.bot.send_message(
-                chat_id=update.message.chat_id,
-                text=preguntas[0]
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(sessions)")}
+        if "question_version" not in columns:
+            self._db.execute("ALTER TABLE sessions ADD COLUMN question_version TEXT")
+
+    def get(self, telegram_id):
+        session = self._cache.get(telegram_id)
+        if session is None:
+            session = self._load(telegram_id)
+            if session is None:
+                return None
+            self._cache[telegram_id] = session
+        self._cache.move_to_end(telegram_id)
+        session.last_seen = monotonic()
+        return session
+
+    def _load(self, telegram_id):
+        row = self._db.execute(
+            "SELECT name, step, current_q, question_version FROM sessions WHERE telegram_id = ?", (telegram_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        answers = [a for (a,) in self._db.execute(
+            "SELECT answer FROM answers WHERE telegram_id = ? ORDER BY idx", (telegram_id,)
+        )]
+        return Session(telegram_id, row[0], row[1], row[2], answers, row[3])
+
+    def get_or_create(self, telegram_id, name):
+        session = self.get(telegram_id)
+        if session is None:
+            session = Session(telegram_id, name)
+            self._cache[telegram_id] = session
+            self.save(session)
+        return session
+
+    def save(self, session):
+        self._db.execute(
+            "INSERT INTO sessions (telegram_id, name, step, current_q, question_version, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(telegram_id) DO UPDATE SET name = excluded.name, step = excluded.step, "
+            "current_q = excluded.current_q, question_version = excluded.question_version, "
+            "updated_at = excluded.updated_at",
+            (session.telegram_id, session.name, session.step, session.current_q,
+             session.question_version, _time.time())
         )
 
-    except Exception as e:
-        print(f"Error al enviar mensajes a {user.telegram_id}: {e}")
+    def add_answer(self, session, text):
+        # Escritura incremental: solo la respuesta nueva
+        self._db.execute(
+            "INSERT OR REPLACE INTO answers (telegram_id, idx, answer) VALUES (?, ?, ?)",
+            (session.telegram_id, len(session.answers), text)
+        )
+        session.answers.append(text)
+
+    def reset(self, session, step=None):
+        """Reinicia el cuestionario del atleta (descarta las respuestas ya guardadas)."""
+        session.step = step
+        session.current_q = 0
+        session.answers = []
+        self._db.execute("BEGIN")
+        try:
+            self._db.execute("DELETE FROM answers WHERE telegram_id = ?", (session.telegram_id,))
+            self.save(session)
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def evict_idle(self):
+        """Saca de memoria las sesiones inactivas. Devuelve cuántas."""
+        limit = monotonic() - self.idle_seconds
+        evicted = 0
+        while self._cache:
+            telegram_id, session = next(iter(self._cache.items()))
+            if session.last_seen > limit:
+                break
+            del self._cache[telegram_id]
+            evicted += 1
+        return evicted
+
+    def __len__(self):
+        return len(self._cache)
+
+    def close(self):
+        self._db.close()
+
+
+@dataclass(frozen=True)
+class QuestionSet:
+    """Una versión inmutable del cuestionario (`version` es el modifiedTime de la hoja)."""
+    version: str
+    questions: tuple
+
+
+class QuestionCatalog:
+    """Versiones del cuestionario de la hoja `Preguntas`.
+
+    Cada versión se guarda inmutable y en disco, para que un cuestionario a
+    medias se siga guardando con las preguntas que vio el atleta aunque la
+    hoja cambie o el bot se reinicie. Publicar una versión nueva es cambiar
+    una sola referencia, así que los handlers nunca ven un estado a medias.
+    """
+
+    MAX_VERSIONS = 20
+
+    def __init__(self, path):
+        self.path = path
+        self.current = None
+        self._versions = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                stored = json.load(f)
+            self._versions = {v: QuestionSet(v, tuple(q)) for v, q in stored["versions"].items()}
+            self.current = self._versions.get(stored["current"])
+        except FileNotFoundError:
+            pass
+        self._index_labels()
+
+    def publish(self, version, questions):
+        question_set = self._versions.get(version)
+        if question_set is None:
+            question_set = QuestionSet(version, tuple(questions))
+            self._versions[version] = question_set
+            # Las versiones más viejas ya no las puede estar respondiendo nadie
+            for old in sorted(self._versions)[:-self.MAX_VERSIONS]:
+                del self._versions[old]
+            self._index_labels()
+            logging.info(f"Cuestionario actualizado a la versión {version} ({len(question_set.questions)} preguntas).")
+        self.current = question_set
+        self._save()
+        return question_set
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "current": self.current.version,
+                "versions": {v: list(qs.questions) for v, qs in self._versions.items()},
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def get(self, version):
+        """La versión pedida, o la actual si no se conoce (sesiones antiguas)."""
+        return self._versions.get(version) or self.current
+
+    def _index_labels(self):
+        # identificador -> texto, calculado una vez por versión publicada (gana la versión más reciente)
+        self._labels = {}
+        for version in sorted(self._versions):
+            for question in self._versions[version].questions:
+                self._labels[question_id(question)] = question
+
+    def label(self, qid):
+        """Texto de la pregunta con ese identificador (el propio identificador si no se conoce)."""
+        return self._labels.get(qid, qid)
+
+
+# Global variables
+question_catalog = None
+sessions = None
+google_clients = None
+revision_journal = None
+drive_folders = None
+pending_albums = {}
+image_pool = None
+known_chats = None
+idempotency = None
+sheet_mirror = None
+revision_sheet = None
+metrics = Metrics()
+google_io = GoogleIO()
+
+def init_google_clients():
+    global google_clients
+    if google_clients is None:
+        google_clients = GoogleClients()
+    return google_clients
+
+async def send_questions_to_user(user, chat_id, send_message, question_set):
+    """Inicia el cuestionario de un atleta. `send_message(chat_id, text)` envía cada mensaje."""
+    # Enviar un mensaje de saludo primero
+    await send_message(chat_id, f"¡Hola {user.nombre}! 👋\n\nComencemos con unas preguntas de seguimiento:")
+
+    await send_message(chat_id, "Empezamos con los perimetros, escribe a continuación en cm las medidas de los siguientes perimetros:")
+
+    # Es necesario actualizar el estado de dicho usuario (cuestionario nuevo desde el principio)
+    # y se fija la versión del cuestionario que va a ver
+    session = sessions.get_or_create(user.telegram_id, user.nombre)
+    session.question_version = question_set.version
+    sessions.reset(session, "ask_questions")
+
+    # Enviar pregunta inicial al usuario
+    await send_message(chat_id, question_set.questions[0])
+
+
+class Broadcaster:
+    """Envío masivo del cuestionario semanal dentro de los límites de Telegram.
+
+    Cada atleta recibe un desfase fijo dentro de la ventana de envío (según
+    un hash de su usuario), así que los envíos se reparten en lugar de salir
+    todos a la vez. Cada mensaje pasa por un cubo global y otro por chat, y
+    un RetryAfter espera lo que pide Telegram antes de reintentar.
+    """
+
+    def __init__(self, bot, global_rate=None, chat_rate=BROADCAST_CHAT_RATE,
+                 window_seconds=BROADCAST_WINDOW_SECONDS, max_retries=BROADCAST_MAX_RETRIES):
+        if global_rate is None:
+            # Con varios workers de webhook cada uno envía a sus atletas: el límite global se reparte
+            global_rate = BROADCAST_GLOBAL_RATE / (WEBHOOK_WORKERS if BOT_MODE == "webhook" else 1)
+        self.bot = bot
+        self.window_seconds = window_seconds
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate)
+        self._chat_rate = chat_rate
+        self._chats = {}
+        self.stats = {"delivered": 0, "failed": 0, "throttled": 0, "no_chat": 0}
+
+    def _offset(self, telegram_id):
+        # Desfase estable por atleta dentro de la ventana
+        return (zlib.crc32(telegram_id.encode("utf-8")) % 10000) / 10000 * self.window_seconds
+
+    async def send_message(self, chat_id, text):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, capacity=1)
+
+        for attempt in range(self.max_retries + 1):
+            # Primero el del chat, para no gastar cupo global mientras se espera a un chat
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await self.bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                self.stats["throttled"] += 1
+                if attempt == self.max_retries:
+                    raise
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                await asyncio.sleep(delay)
+            except (TimedOut, NetworkError):
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+    async def _send_to(self, user, question_set):
+        chat_id = known_chats.get(user.telegram_id)
+        if chat_id is None:
+            # Telegram solo deja escribir a quien ya ha hablado con el bot
+            self.stats["no_chat"] += 1
+            return
+
+        await asyncio.sleep(self._offset(user.telegram_id))
+        try:
+            await send_questions_to_user(user, chat_id, self.send_message, question_set)
+            self.stats["delivered"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            logging.warning(f"Error al enviar mensajes a {user.telegram_id}: {e}")
+
+    async def run(self, users, question_set):
+        await asyncio.gather(*(self._send_to(user, question_set) for user in users))
+        return dict(self.stats)
+
 
 async def send_questions_to_all_users(context):
-    # Crear una lista de tareas asíncronas para cada usuario
-    tasks = [send_questions_to_user(user, context, Questions) for user in ActiveUsers]
+    users = users_directory.all()
+    logging.info(f"Enviando el cuestionario semanal a {len(users)} atletas en {BROADCAST_WINDOW_SECONDS:.0f}s...")
 
-    # Ejecutar todas las tareas de manera concurrente
-    await asyncio.gather(*tasks)
+    stats = await Broadcaster(context.bot, window_seconds=BROADCAST_WINDOW_SECONDS).run(users, question_catalog.current)
 
-def schedule_weekly_tasks(application):
-    job_queue = application.job_queue
+    summary = (
+        f"📨 Cuestionario semanal: {stats['delivered']} entregados, {stats['failed']} fallidos, "
+        f"{stats['no_chat']} sin chat conocido, {stats['throttled']} esperas por límite de Telegram."
+    )
+    logging.info(summary)
+    for admin in BOT_ADMINS:
+        chat_id = known_chats.get(admin)
+        if chat_id is not None:
+            await context.bot.send_message(chat_id=chat_id, text=summary)
+    return stats
+
+async def weekly_questions_job(context):
+    # Solo ejecutar si hoy es domingo
+    if datetime.now(BOT_TIMEZONE).weekday() == 6:  # domingo
+        await send_questions_to_all_users(context)
 
+def schedule_weekly_tasks(application):
     # Usamos el job_queue de telegram para programar una tarea
     job_queue = application.job_queue
 
-    def callback_wrapper(context):
-        # Solo ejecutar si hoy es domingo
-        if datetime.today().weekday() == 6:  # domingo
-            send_questions_to_all_users(context)
-
     # Programar para que se ejecute todos los días a las 10:00
     job_queue.run_daily(
-        callback=callback_wrapper,
-        time=time(hour=10, minute=0),
+        callback=weekly_questions_job,
+        time=time(hour=10, minute=0, tzinfo=BOT_TIMEZONE),
         name="weekly_questions"
     )
 
 def readQuestions():
-# Define el scope (alcances)
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-
-    # Usa el archivo de la cuenta de servicio
-    creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
-
-    # Autoriza cliente gspread
-    client = gspread.authorize(creds)
-
-    # Abre el archivo por nombre (debes haberlo compartido con el correo de la cuenta de servicio)
-    sheet = client.open("Preguntas").sheet1
+    # Hoja ya abierta por los clientes compartidos (debe estar compartida con la cuenta de servicio)
+    sheet = google_clients.questions_ws
 
     # Lee preguntas de la primera columna
     preguntas = sheet.col_values(1)
     preguntas.append("Por ultimo, adjunta unas fotos para evaluar tu composición corporal (Frente, Perfil izquierdo, Perfil derecho y espalda)! Si no lo deseas, escribe NO")
     return preguntas
 
+def questions_modified_time(service):
+    """modifiedTime de la hoja `Preguntas` en Drive: una consulta barata de metadatos."""
+    spreadsheet_id = google_clients.questions_ws.spreadsheet.id
+    return service.files().get(fileId=spreadsheet_id, fields="modifiedTime").execute()["modifiedTime"]
+
+def session_questions(session):
+    """Preguntas de la versión del cuestionario fijada en la sesión."""
+    return question_catalog.get(session.question_version).questions
+
+async def refresh_questions_job(context):
+    # Solo se relee la hoja si su modifiedTime ha cambiado; todo fuera del bucle de eventos
+    try:
+        version = await google_io.drive("drive_metadata", questions_modified_time)
+        if question_catalog.current is None or version != question_catalog.current.version:
+            preguntas = await google_io.sheets("sheet_read", readQuestions)
+            question_catalog.publish(version, preguntas)
+    except Exception as e:
+        logging.warning(f"No se pudo comprobar la hoja de preguntas, se mantiene la versión actual: {e}")
+
 def readActiveUsers():
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-    creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
-    client = gspread.authorize(creds)
-    sheet = client.open("Users").sheet1
+    sheet = google_clients.users_ws
 
     records = sheet.get_all_records()  # [{'Nombre': ..., 'Usuario': ...}, ...]
 
@@ -130,11 +944,24 @@ def readActiveUsers():
 
     return users
 
+users_directory = UserDirectory(readActiveUsers)
+
+def get_user_state(user_id):
+    """Estado de conversación de un usuario activo (None si no está habilitado)."""
+    user = users_directory.get(user_id)
+    if user is None:
+        return None
+
+    return sessions.get_or_create(user_id, user.nombre)
+
+async def refresh_users_job(context):
+    # Cada ejecución relee la hoja: el intervalo del job ya es el TTL
+    await users_directory.refresh_async()
+
+@instrumented("start")
 async def start(update, context):
     telegram_id = str(update.message.from_user.name)
-    users = readActiveUsers()
-
-    found_user = next((u for u in users if u.telegram_id == telegram_id), None)
+    found_user = users_directory.get(telegram_id)
 
     if found_user:
         await context.bot.send_message(chat_id=update.message.chat_id,
@@ -143,50 +970,39 @@ async def start(update, context):
         "Aquí podrás compartir cómo te estás sintiendo, cómo vas con tu plan y recibir recordatorios importantes.\n\n"
         "Estoy aquí para acompañarte en cada paso del camino hacia tu mejor versión. ¡Vamos a por ello! 🚀")
     else:
-        context.bot.send_message(chat_id=update.message.chat_id,
+        await context.bot.send_message(chat_id=update.message.chat_id,
                                  text="Hable con Manuel Ángel Trenas, su usuario no está habilitado.")
 
+@instrumented("handle_text")
 async def handle_text(update, context):
     user_id = update.message.from_user.name
     user_name = update.message.from_user.full_name
 
     text = update.message.text
 
-    ActiveUsers = readActiveUsers()
-    for user in ActiveUsers:
-        if user.telegram_id not in user_data:
-            user_data[user.telegram_id] = {
-                "name": user.nombre,
-                "step": None,  # se define cuando inicie el flujo
-                "current_q": 0,
-                "answers": []
-            }
-
     # Verificamos si el usuario está autorizado
-    if user_id not in user_data:
-        context.bot.send_message(chat_id=update.message.chat_id, text="Tu usuario no está habilitado.")
+    session = get_user_state(user_id)
+    if session is None:
+        await context.bot.send_message(chat_id=update.message.chat_id, text="Tu usuario no está habilitado.")
         return
 
     # Flujo de recolección de datos
-    if user_data[user_id]["step"] == None:
-        user_data[user_id]["name"] = user_name
-        user_data[user_id]["answers"] = []
-        user_data[user_id]["current_q"] = 0
+    if session.step == None:
+        session.name = user_name
+        sessions.reset(session)
         await context.bot.send_message(chat_id=update.message.chat_id, text=f"¡Hola {user_name}! ¿Qué tal estás? Si tienes alguna duda no dudes en contactar conmigo via Whatsapp o mediante llamada telefónica.")
     
-    elif user_data[user_id]["step"] == "ask_questions":
-        idx = user_data[user_id]["current_q"]
+    elif session.step == "ask_questions":
+        idx = session.current_q
 
         # Guardamos la respuesta
-        user_data[user_id]["answers"].append(text)
+        sessions.add_answer(session, text)
     
         # ¿Es la última pregunta (la de las fotos)?
-        if idx == len(Questions) - 1 and text.strip().upper() == "NO":
+        if idx == len(session_questions(session)) - 1 and text.strip().upper() == "NO":
             # Guardar datos y cerrar flujo
             await save_user_data(user_id)
-            user_data[user_id]["step"] = None
-            user_data[user_id]["current_q"] = 0
-            user_data[user_id]["answers"] = []  # <-- limpia respuestas ya guardadas
+            sessions.reset(session)  # <-- limpia respuestas ya guardadas
 
             await context.bot.send_message(
                 chat_id=update.message.chat_id,
@@ -195,166 +1011,160 @@ async def handle_text(update, context):
             return
     
         # Si no, seguimos normalmente
-        user_data[user_id]["current_q"] += 1
-    if user_data[user_id]["step"] == "ask_questions":
+        session.current_q += 1
+        sessions.save(session)
+    if session.step == "ask_questions":
         await ask_next_question(update, context)
 
 
 
+@instrumented("handle_photo")
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.message.from_user
-    uid = f"@{user.username}"
-    
-    user_id = update.message.from_user.name
-    user_name = update.message.from_user.full_name
-
-    ActiveUsers = readActiveUsers()
-    for userAux in ActiveUsers:
-        if userAux.telegram_id not in user_data:
-            user_data[userAux.telegram_id] = {
-                "name": userAux.nombre,
-                "step": None,  # se define cuando inicie el flujo
-                "current_q": 0,
-                "answers": []
-            }
+    message = update.message
+    user_id = message.from_user.name
 
     # Verificamos si el usuario está autorizado
-    if user_id not in user_data:
-        context.bot.send_message(chat_id=update.message.chat_id, text="Tu usuario no está habilitado.")
+    if get_user_state(user_id) is None:
+        await context.bot.send_message(chat_id=message.chat_id, text="Tu usuario no está habilitado.")
         return
 
-    if user_data[user_id]["step"] in ["ask_questions", "upload_photos"]:
-        await save_user_data(user_id)
-        user_data[user_id]["step"] = None
-        # Descargamos el archivo (la versión de mayor resolución está al final)
-        photo = update.message.photo[-1]
+    # Las fotos de un álbum llegan como updates separados: se agrupan por
+    # media_group_id y se procesan juntas cuando deja de llegar ninguna más.
+    album_id = message.media_group_id
+    album = pending_albums.get(album_id) if album_id else None
+    if album is None:
+        in_flow, revision = await _start_photo_batch(user_id)
+        album = {"update": update, "in_flow": in_flow, "revision": revision, "photos": [], "task": None}
+        if album_id is None:
+            album["photos"].append(message.photo[-1])
+            await store_photos(context, album)
+            return
+        pending_albums[album_id] = album
+
+    # La versión de mayor resolución está al final
+    album["photos"].append(message.photo[-1])
+    if album["task"] is not None:
+        album["task"].cancel()
+    album["task"] = context.application.create_task(_flush_album(context, album_id), update=update)
+
+async def _start_photo_batch(user_id):
+    """Cierra el cuestionario si estaba en curso.
+
+    Devuelve si las fotos son de la revisión y, en formato ancho, el id de la
+    revisión guardada, a cuya fila se añadirán los enlaces de las fotos.
+    """
+    # Dentro del flujo de revisión (o de /fotos) las fotos van a la carpeta del atleta
+    session = sessions.get(user_id)
+    in_flow = session.step in ["ask_questions", "upload_photos"]
+    revision = None
+    if in_flow:
+        # Las respuestas quedan en el diario antes de borrarlas de la sesión
+        revision = await save_user_data(user_id)
+        sessions.reset(session)  # <-- limpia respuestas ya guardadas
+    return in_flow, revision
+
+async def _flush_album(context, album_id):
+    await asyncio.sleep(ALBUM_WAIT_SECONDS)
+    album = pending_albums.pop(album_id)
+    await store_photos(context, album)
+
+async def _upload_photo(context, photo, folder_name, limit):
+    """Descarga, normaliza y sube una foto. Devuelve (imagen procesada, fichero completo, miniatura).
+
+    Devuelve None si la foto ya estaba subida (misma foto de Telegram o mismo contenido).
+    """
+    async with limit:
+        if idempotency.photo(file_unique_id=photo.file_unique_id) is not None:
+            metrics.inc("bot_duplicate_photos_total")
+            return None
+
         tg_file = await context.bot.get_file(photo.file_id)
-        # Asegúrate de crear la carpeta una sola vez
-        os.makedirs("tmp", exist_ok=True)
-
-        # Construye la ruta dentro de ./tmp, no en la raíz del disco
-        local_path = os.path.join("tmp", f"{photo.file_id}.jpg")
-        await tg_file.download_to_drive(local_path)
-
-        scope = [
-        'https://spreadsheets.google.com/feeds',
-        'https://www.googleapis.com/auth/drive'
-        ]
-        creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
-
-        # 4) Subir a Google Drive usando la API oficial
-        drive_service = build('drive', 'v3', credentials=creds)
-        # 1. Crear estructura: [root]/Fotos/[nombre]
-        root_folder = "1G-QgvfDD-dqMPzjuaA71ii7t6aWn_prX"
-
-        # Asegúrate de usar el nombre real, no el @usuario
-        nombre_usuario = user_data[uid]["name"]
-        user_folder = ensure_drive_folder(drive_service, root_folder, nombre_usuario)
-
-        # 2. Subir dentro de la carpeta del usuario
-        file_metadata = {
-            'name': os.path.basename(local_path),
-            'parents': [user_folder]
-        }
-        media = MediaFileUpload(local_path, mimetype='image/jpeg')
-        file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webContentLink'
-        ).execute()
-        try:
-            media._fd.close()
-        except Exception:
-            pass
-        # Hacerlo público:
-        drive_service.permissions().create(
-            fileId=file['id'],
-            body={'type': 'anyone', 'role': 'reader'}
-        ).execute()
-        public_url = file['webContentLink']
+        original = bytes(await tg_file.download_as_bytearray())
 
-        # 5) Adjuntar en tu Google Sheet la fórmula =IMAGE(...)
-        client = gspread.authorize(creds)
-        #sheet = client.open("Revisiones").sheet1
-        sheet = client.open("Revisiones").worksheet("Revision")
-        nombre = user_data[uid]["name"]
-        fecha = datetime.now().strftime("%Y-%m-%d")
-        pregunta = "Imagen adjunta"
-        formula = f'=IMAGE("{public_url}"; 4; {photo.height}; {photo.width})'
+        # Reenviada como fichero nuevo (otro file_unique_id) pero con el mismo contenido
+        digest = hashlib.sha256(original).hexdigest()
+        known = idempotency.photo(sha256=digest)
+        if known is not None:
+            idempotency.record_photo(photo.file_unique_id, digest, known["id"], known["thumb_id"], known["thumb_link"])
+            metrics.inc("bot_duplicate_photos_total")
+            return None
 
-        # Insertar la fila completa: Nombre | Fecha | @usuario | Pregunta | Imagen
-        row = [nombre, fecha, uid, pregunta, formula]
-        sheet.append_row(row, value_input_option='USER_ENTERED')
+        # EXIF, giro, tamaño máximo y miniatura en el pool de procesos (nada de CPU en el bucle)
+        image = await process_image(original)
 
-        # 6) Limpiar y notificar
-        os.remove(local_path)
-        user_data[uid]["step"] = None
-        user_data[uid]["current_q"] = 0
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="✅ ¡Imagen recibida y almacenada correctamente!"
-        )
-    else:
-        # Descargamos el archivo (la versión de mayor resolución está al final)
-        photo = update.message.photo[-1]
-        tg_file = await context.bot.get_file(photo.file_id)
-        # Asegúrate de crear la carpeta una sola vez
-        os.makedirs("tmp", exist_ok=True)
-
-        # Construye la ruta dentro de ./tmp, no en la raíz del disco
-        local_path = os.path.join("tmp", f"{photo.file_id}.jpg")
-        await tg_file.download_to_drive(local_path)
-
-        scope = [
-        'https://spreadsheets.google.com/feeds',
-        'https://www.googleapis.com/auth/drive'
-        ]
-        creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
-
-        # 4) Subir a Google Drive usando la API oficial
-        drive_service = build('drive', 'v3', credentials=creds)
-        folder_id = "1G-QgvfDD-dqMPzjuaA71ii7t6aWn_prX"  # tu carpeta Drive
-        file_metadata = {
-            'name': os.path.basename(local_path),
-            'parents': [folder_id]
-        }
-        media = MediaFileUpload(local_path, mimetype='image/jpeg')
-        file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id, webContentLink'
-        ).execute()
+        if folder_name:
+            folder_id = await drive_folders.resolve(DRIVE_ROOT_FOLDER_ID, folder_name)
+        else:
+            folder_id = DRIVE_ROOT_FOLDER_ID  # tu carpeta Drive
         try:
-            media._fd.close()
-        except Exception:
-            pass
-        # Hacerlo público:
-        drive_service.permissions().create(
-            fileId=file['id'],
-            body={'type': 'anyone', 'role': 'reader'}
-        ).execute()
-        public_url = file['webContentLink']
-
-        # 5) Adjuntar en tu Google Sheet la fórmula =IMAGE(...)
-        client = gspread.authorize(creds)
-        #sheet = client.open("Revisiones").sheet1
-        sheet = client.open("Revisiones").worksheet("Revision")
-        nombre = user_data[uid]["name"]
+            files = await google_io.drive("drive_create", upload_image_files, image, photo.file_id, folder_id)
+        except HttpError as e:
+            # La carpeta cacheada ya no existe (borrada a mano en Drive): se resuelve de nuevo
+            if not folder_name or e.resp.status != 404:
+                raise
+            drive_folders.invalidate(DRIVE_ROOT_FOLDER_ID, folder_name)
+            folder_id = await drive_folders.resolve(DRIVE_ROOT_FOLDER_ID, folder_name)
+            files = await google_io.drive("drive_create", upload_image_files, image, photo.file_id, folder_id)
+
+        full, thumb = files
+        idempotency.record_photo(photo.file_unique_id, digest, full["id"], thumb["id"], thumb["webContentLink"])
+        return (image,) + files
+
+@instrumented("store_photos")
+async def store_photos(context, album):
+    """Sube las fotos de un álbum (o una foto suelta) y registra sus filas de una vez."""
+    update = album["update"]
+    uid = update.message.from_user.name
+    photos = album["photos"]
+
+    # 1) Subidas concurrentes a Drive (acotadas), en la carpeta del atleta si es su revisión
+    # Asegúrate de usar el nombre real, no el @usuario
+    nombre = sessions.get(uid).name
+    folder_name = nombre if album["in_flow"] else None
+    limit = asyncio.Semaphore(ALBUM_UPLOAD_CONCURRENCY)
+    results = await asyncio.gather(*(_upload_photo(context, photo, folder_name, limit) for photo in photos))
+    # Las repetidas ya tienen fichero público y fila en la hoja
+    uploads = [u for u in results if u is not None]
+    duplicates = len(results) - len(uploads)
+
+    # 2) Todos los permisos públicos (imagen completa y miniatura) en una única petición batch
+    if uploads:
+        await google_io.drive("drive_permission", make_files_public, [f['id'] for _, full, thumb in uploads for f in (full, thumb)])
+
+    # 3) Formato ancho: los enlaces van en las columnas de foto de la fila de la revisión.
+    #    Formato largo: una fila =IMAGE(...) por foto con la miniatura: Nombre | Fecha | @usuario | Pregunta | Imagen
+    #    (la imagen completa se llega desde la miniatura, ver upload_image_files)
+    #    (todas en la misma entrada del diario, el flusher las escribe juntas)
+    if REVISION_FORMAT == "wide":
+        links = [full["webContentLink"] for _, full, _ in uploads]
+        revision = album.get("revision")
+        if links and revision is not None:
+            revision_journal.append([photo_links_patch(revision, links)])
+        elif links:
+            revision_journal.append([add_photo_links(new_wide_revision(nombre, uid), links)])
+    elif uploads:
         fecha = datetime.now().strftime("%Y-%m-%d")
-        pregunta = "Imagen adjunta"
-        formula = f'=IMAGE("{public_url}"; 4; {photo.height}; {photo.width})'
-
-        # Insertar la fila completa: Nombre | Fecha | @usuario | Pregunta | Imagen
-        row = [nombre, fecha, uid, pregunta, formula]
-        sheet.append_row(row, value_input_option='USER_ENTERED')
+        rows = []
+        for image, full, thumb in uploads:
+            formula = f'=IMAGE("{thumb["webContentLink"]}"; 4; {image.thumb_height}; {image.thumb_width})'
+            rows.append([nombre, fecha, uid, PHOTO_QUESTION, formula])
+        revision_journal.append(rows, value_input_option='USER_ENTERED')
+
+    if not uploads:
+        text = "♻️ Esta imagen ya estaba guardada." if duplicates == 1 else f"♻️ Estas {duplicates} imágenes ya estaban guardadas."
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        return
 
-        # 6) Limpiar y notificar
-        os.remove(local_path)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="✅ ¡Imagen recibida y almacenada correctamente!"
-        )
+    # 4) Un único aviso por álbum
+    if len(uploads) == 1:
+        text = "✅ ¡Imagen recibida y almacenada correctamente!"
+    else:
+        text = f"✅ ¡{len(uploads)} imágenes recibidas y almacenadas correctamente!"
+    if duplicates:
+        text += f" ({duplicates} ya estaban guardadas)"
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
 
+@instrumented("instrucciones_command")
 async def instrucciones_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mensaje = (
         "ℹ️ *Instrucciones de uso*\n\n"
@@ -371,15 +1181,22 @@ async def instrucciones_command(update: Update, context: ContextTypes.DEFAULT_TY
         "• No dividas una respuesta en varios mensajes.\n"
         "• Espera siempre a que el bot envíe la siguiente pregunta.\n\n"
         "Este funcionamiento es clave para que la información quede correctamente registrada.\n\n"
+        "📈 Con /progreso puedes ver la evolución de tus medidas.\n\n"
         "Gracias por tu colaboración."
     )
 
     await update.message.reply_text(mensaje, parse_mode="Markdown")
     
 
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+def _drive_query_literal(value):
+    # Las comillas y barras del nombre deben escaparse en las consultas de Drive
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
 def ensure_drive_folder(service, parent_id, folder_name):
     # Buscar si ya existe la carpeta
-    query = f"'{parent_id}' in parents and name = '{folder_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
+    query = f"'{parent_id}' in parents and name = '{_drive_query_literal(folder_name)}' and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false"
     results = service.files().list(q=query, fields="files(id, name)").execute()
     folders = results.get("files", [])
     if folders:
@@ -388,40 +1205,347 @@ def ensure_drive_folder(service, parent_id, folder_name):
     # Si no existe, crearla
     file_metadata = {
         'name': folder_name,
-        'mimeType': 'application/vnd.google-apps.folder',
+        'mimeType': FOLDER_MIME_TYPE,
         'parents': [parent_id]
     }
     folder = service.files().create(body=file_metadata, fields='id').execute()
     return folder.get('id')
 
+def list_drive_folders(service, parent_id):
+    """Todas las subcarpetas de `parent_id` como {nombre: id}."""
+    query = f"'{parent_id}' in parents and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false"
+    folders = {}
+    page_token = None
+    while True:
+        results = service.files().list(
+            q=query,
+            fields="nextPageToken, files(id, name)",
+            pageSize=1000,
+            pageToken=page_token
+        ).execute()
+        for folder in results.get("files", []):
+            # Si hay duplicados nos quedamos con el primero, igual que ensure_drive_folder
+            folders.setdefault(folder["name"], folder["id"])
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return folders
+
+
+class DriveFolderCache:
+    """Caché de IDs de carpetas de Drive por (padre, nombre).
+
+    Se persiste en disco para sobrevivir a reinicios y se precalienta al
+    arrancar listando la carpeta raíz una sola vez. La búsqueda/creación es
+    single-flight: varias subidas simultáneas del mismo atleta esperan a la
+    misma tarea en lugar de crear carpetas duplicadas.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._ids = {}
+        self._inflight = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._ids = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.warning(f"Caché de carpetas de Drive corrupta, se reconstruye: {e}")
+
+    @staticmethod
+    def _key(parent_id, name):
+        return f"{parent_id}/{name}"
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._ids, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    async def warm(self, parent_id):
+        folders = await google_io.drive("drive_list", list_drive_folders, parent_id)
+        for name, folder_id in folders.items():
+            self._ids[self._key(parent_id, name)] = folder_id
+        self._save()
+        logging.info(f"Caché de carpetas de Drive precargada con {len(folders)} carpetas.")
+
+    async def resolve(self, parent_id, name):
+        key = self._key(parent_id, name)
+        folder_id = self._ids.get(key)
+        if folder_id:
+            return folder_id
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup(key, parent_id, name))
+            self._inflight[key] = task
+        # shield: si se cancela quien espera (un álbum), la búsqueda sigue para los demás
+        return await asyncio.shield(task)
+
+    async def _lookup(self, key, parent_id, name):
+        try:
+            folder_id = await google_io.drive("drive_folder", ensure_drive_folder, parent_id, name)
+            self._ids[key] = folder_id
+            self._save()
+            return folder_id
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, parent_id, name):
+        if self._ids.pop(self._key(parent_id, name), None):
+            self._save()
+
+@dataclass
+class ProcessedImage:
+    """Foto normalizada (JPEG sin EXIF) y su miniatura para la hoja."""
+    data: bytes
+    width: int
+    height: int
+    thumb: bytes
+    thumb_width: int
+    thumb_height: int
+
+
+def normalize_image(data, max_side=IMAGE_MAX_SIDE, quality=IMAGE_QUALITY,
+                    thumb_side=THUMBNAIL_SIDE, thumb_quality=THUMBNAIL_QUALITY):
+    """Endereza según EXIF, limita el tamaño, re-codifica sin metadatos y genera la miniatura.
+
+    Se ejecuta en el pool de procesos, así que solo recibe y devuelve datos serializables.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source).convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    full = io.BytesIO()
+    # Al no pasar exif= el JPEG resultante sale sin metadatos (ni GPS)
+    image.save(full, "JPEG", quality=quality, optimize=True, progressive=True)
+
+    thumb_image = image.copy()
+    thumb_image.thumbnail((thumb_side, thumb_side), Image.LANCZOS)
+    thumb = io.BytesIO()
+    thumb_image.save(thumb, "JPEG", quality=thumb_quality, optimize=True)
+
+    return ProcessedImage(full.getvalue(), image.width, image.height,
+                          thumb.getvalue(), thumb_image.width, thumb_image.height)
+
+def get_image_pool():
+    global image_pool
+    if image_pool is None:
+        # spawn: los procesos hijos no heredan hilos ni conexiones del bot
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return image_pool
+
+async def process_image(data):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_image_pool(), normalize_image, data)
+
+def upload_image_files(service, image, base_name, parent_id):
+    """Sube la imagen normalizada y su miniatura. Devuelve (fichero, miniatura).
+
+    La hoja larga solo enlaza la miniatura: su `appProperties.fullFileId` apunta
+    a la imagen completa, que es la que abre la web (/api/photos/view/<id>?size=full).
+    """
+    full = upload_drive_file(service, io.BytesIO(image.data), f"{base_name}.jpg", parent_id)
+    thumb = upload_drive_file(service, io.BytesIO(image.thumb), f"{base_name}_thumb.jpg", parent_id,
+                              app_properties={"fullFileId": full["id"]})
+    return full, thumb
+
+def upload_drive_file(service, fileobj, name, parent_id, app_properties=None):
+    """Sube una imagen a Drive por trozos (subida reanudable). Devuelve {id, webContentLink}."""
+    file_metadata = {
+        'name': name,
+        'parents': [parent_id]
+    }
+    if app_properties:
+        file_metadata['appProperties'] = app_properties
+    media = MediaIoBaseUpload(fileobj, mimetype='image/jpeg', chunksize=UPLOAD_CHUNK_BYTES, resumable=True)
+    request = service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id, webContentLink'
+    )
+    file = None
+    while file is None:
+        _, file = request.next_chunk()
+    return file
+
+def make_files_public(service, file_ids):
+    """Hace públicos varios ficheros con una sola petición batch de Drive."""
+    errors = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors.append(exception)
+
+    batch = service.new_batch_http_request(callback=callback)
+    for file_id in file_ids:
+        batch.add(service.permissions().create(
+            fileId=file_id,
+            body={'type': 'anyone', 'role': 'reader'}
+        ))
+    batch.execute()
+    if errors:
+        raise errors[0]
+
 
 async def ask_next_question(update, context):
     user_id = update.message.from_user.name
-    idx = user_data[user_id]["current_q"]
-    if idx < len(Questions):
-        await context.bot.send_message(chat_id=update.message.chat_id, text=Questions[idx])
+    session = sessions.get(user_id)
+    idx = session.current_q
+    preguntas = session_questions(session)
+    if idx < len(preguntas):
+        await context.bot.send_message(chat_id=update.message.chat_id, text=preguntas[idx])
     else:
         await context.bot.send_message(chat_id=update.message.chat_id, text="Gracias por completar las preguntas!")
-        user_data[user_id]["current_q"] = 0
         await save_user_data(user_id)
+        sessions.reset(session)
+
+REVISION_HEADERS = ["Nombre", "Fecha", "Telegram", "Pregunta", "Respuesta"]
+_revision_headers_ok = False
+
+# Formato ancho: estas columnas fijas y luego una por pregunta (su identificador) y por foto
+WIDE_REVISION_HEADERS = ["Revision", "Nombre", "Fecha", "Telegram"]
+PHOTO_COLUMN_PREFIX = "foto_"
+# Prefijo de los ids de las revisiones migradas desde `Revisiones` (los del bot son hexadecimales)
+MIGRATED_REVISION_PREFIX = "m"
+# Marca de los registros que completan una revisión ya guardada (las fotos) en vez de añadir fila
+PATCH_KEY = "_patch"
+PHOTO_QUESTION = "Imagen adjunta"
+
+def question_id(text):
+    """Identificador estable de una pregunta: "Perímetro cintura (cm)" -> "perimetro_cintura_cm"."""
+    ascii_text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode().lower()
+    return re.sub(r"[^a-z0-9]+", "_", ascii_text).strip("_")[:60] or "pregunta"
+
+def new_wide_revision(nombre, telegram_username, fecha=None, revision_id=None):
+    return {
+        "Revision": revision_id or uuid.uuid4().hex[:12],
+        "Nombre": nombre,
+        "Fecha": fecha or datetime.now().strftime("%Y-%m-%d"),
+        "Telegram": telegram_username,
+    }
 
-async def save_user_data(telegram_username):
-    # Autenticación
-    scope = [
-        'https://spreadsheets.google.com/feeds',
-        'https://www.googleapis.com/auth/drive'
-    ]
-    creds = ServiceAccountCredentials.from_json_keyfile_name('credentials.json', scope)
-    client = gspread.authorize(creds)
-
-    #sheet = client.open("Revisiones").sheet1
-    sheet = client.open("Revisiones").worksheet("Revision")
+def build_wide_revision(session):
+    """Registro (columna -> valor) con todas las respuestas de la sesión."""
+    record = new_wide_revision(session.name, session.telegram_id)
+    preguntas = session_questions(session)
+    for idx, respuesta in enumerate(session.answers):
+        qid = question_id(preguntas[idx]) if idx < len(preguntas) else f"pregunta_{idx + 1}"
+        if qid in record:
+            qid = f"{qid}_{idx + 1}"
+        record[qid] = respuesta
+    return record
+
+def photo_links_patch(revision_id, links):
+    """Registro que añade los enlaces de las fotos a la fila de una revisión ya guardada."""
+    return add_photo_links({"Revision": revision_id, PATCH_KEY: True}, links)
+
+def add_photo_links(record, links):
+    position = 1 + sum(1 for c in record if c.startswith(PHOTO_COLUMN_PREFIX))
+    for offset, link in enumerate(links):
+        record[f"{PHOTO_COLUMN_PREFIX}{position + offset}"] = link
+    return record
+
+def column_label(column):
+    """Nombre legible de una columna del formato ancho ("foto_2" -> "Imagen adjunta")."""
+    if column.startswith(PHOTO_COLUMN_PREFIX) and column[len(PHOTO_COLUMN_PREFIX):].isdigit():
+        return PHOTO_QUESTION
+    return question_catalog.label(column) if question_catalog is not None else column
+
+
+class RevisionSheet:
+    """Destino del diario de revisiones en Sheets, para los dos formatos.
+
+    Las filas largas (listas) van a `Revisiones` como siempre. Los registros
+    anchos (diccionarios columna -> valor) son una fila cada uno en la pestaña
+    ancha, cuya cabecera crece sola cuando aparece una pregunta o una foto nueva.
+    Los registros con PATCH_KEY completan la fila de su revisión: si va en el
+    mismo lote se funden antes de escribir, y si no se actualizan sus celdas.
+    """
+
+    def __init__(self, clients):
+        self._clients = clients
+        self._header = None
+        self.calls = 0  # llamadas a Sheets hechas, para cobrarlas en el cupo de google_io
+
+    def _call(self, fn, *args, **kwargs):
+        self.calls += 1
+        return fn(*args, **kwargs)
+
+    def append_rows(self, rows, value_input_option="RAW"):
+        long_rows = [r for r in rows if not isinstance(r, dict)]
+        records = [r for r in rows if isinstance(r, dict)]
+        if long_rows:
+            if not _revision_headers_ok:
+                self._call(ensure_revision_headers, self._clients.revision_ws)
+            self._call(self._clients.revision_ws.append_rows, long_rows, value_input_option=value_input_option)
+        if records:
+            self._write_records(self._clients.wide_revision_ws, records)
+
+    def _write_records(self, sheet, records):
+        new = []
+        by_id = {}
+        patches = []
+        for record in records:
+            record = dict(record)
+            if record.pop(PATCH_KEY, False):
+                target = by_id.get(record["Revision"])
+                if target is not None:
+                    target.update(record)
+                else:
+                    patches.append(record)
+            else:
+                new.append(record)
+                by_id[record["Revision"]] = record
+
+        header = self._ensure_columns(sheet, new + patches)
+        updates = []
+        if patches:
+            revision_ids = self._call(sheet.col_values, 1)
+            for patch in patches:
+                if patch["Revision"] not in revision_ids:
+                    # La fila de la revisión no está (borrada a mano): las fotos van en una fila propia
+                    logging.warning(f"No se encontró la revisión {patch['Revision']}, sus fotos van en una fila nueva")
+                    new.append(patch)
+                    continue
+                row = revision_ids.index(patch["Revision"]) + 1
+                updates += [{"range": rowcol_to_a1(row, header.index(c) + 1), "values": [[v]]}
+                            for c, v in patch.items() if c != "Revision"]
+
+        # Las celdas de las fotos antes que las filas nuevas: reescribirlas es inocuo, así que
+        # si falla cualquiera de las dos el diario puede repetir el lote sin duplicar filas
+        # RAW: en este formato las fotos son enlaces, no fórmulas
+        if updates:
+            self._call(sheet.batch_update, updates, value_input_option="RAW")
+        if new:
+            self._call(sheet.append_rows, [[r.get(c, "") for c in header] for r in new],
+                       value_input_option="RAW", table_range="A1")
+
+    def _ensure_columns(self, sheet, records):
+        if self._header is None:
+            self._header = self._call(sheet.row_values, 1)
+        missing = list(dict.fromkeys(c for r in records for c in r if c not in self._header))
+        if not missing and self._header:
+            return self._header
+
+        # Otro proceso puede haber añadido columnas: se parte de la cabecera actual
+        header = self._call(sheet.row_values, 1) or list(WIDE_REVISION_HEADERS)
+        header += [c for c in dict.fromkeys(c for r in records for c in r) if c not in header]
+        if len(header) > sheet.col_count:
+            self._call(sheet.add_cols, len(header) - sheet.col_count)
+        self._call(sheet.update, [header], "A1")
+        self._header = header
+        return header
+
+def ensure_revision_headers(sheet):
+    """Comprueba los encabezados de `Revisiones` una sola vez por proceso."""
+    global _revision_headers_ok
+    if _revision_headers_ok:
+        return
 
-    # 1) Encabezados
-    headers = ["Nombre", "Fecha", "Telegram", "Pregunta", "Respuesta"]
-    if sheet.row_values(1) != headers:
+    if sheet.row_values(1) != REVISION_HEADERS:
         sheet.clear()
-        sheet.append_row(headers)
+        sheet.append_row(REVISION_HEADERS)
         # Intentamos congelar la primera fila, pero si falla (solo 1 fila), lo ignoramos
         try:
             set_frozen(sheet, rows=1)
@@ -429,36 +1553,752 @@ async def save_user_data(telegram_username):
             # Esto evita el “You can't freeze all visible rows” sin detener la ejecución
             if "freeze all visible rows" not in str(e).lower():
                 raise
-        
+    _revision_headers_ok = True
+
+class RevisionJournal:
+    """Cola write-behind de filas para `Revisiones` con diario local en disco.
+
+    Cada lote de filas se añade como una línea JSON a un fichero append-only
+    (con fsync) antes de responder al atleta. El flusher envía periódicamente
+    las filas pendientes de todos los usuarios en escrituras agrupadas y
+    avanza un offset persistido; al arrancar se reenvía todo lo que quede
+    después de ese offset.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self._lock = threading.Lock()
+        self._pending = []  # [(offset_fin_linea, entrada)]
+        self.flushed_rows = 0
+        self.last_flush_at = None
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._offset = self._read_offset()
+        self._replay()
+        self._fh = open(self.path, "ab")
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.offset_path)
+        self._offset = offset
+
+    def _replay(self):
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if self._offset > size:
+            # El diario se ha borrado o vaciado a mano: el offset ya no apunta a nada
+            self._write_offset(0)
+        if not size:
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            position = self._offset
+            for line in f:
+                # Una línea sin salto final es una escritura interrumpida por un crash
+                if not line.endswith(b"\n"):
+                    break
+                position += len(line)
+                try:
+                    self._pending.append((position, json.loads(line)))
+                except ValueError as e:
+                    logging.warning(f"Diario de revisiones: se descarta una entrada ilegible en el byte {position - len(line)}: {e}")
+
+        # Se corta lo que quede de la escritura interrumpida: si no, la siguiente
+        # entrada se pegaría a esos bytes y el diario dejaría de poder leerse
+        if position < size:
+            logging.warning(f"Diario de revisiones: se descarta una escritura incompleta al final de {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(position)
+
+        if self._pending:
+            logging.info(f"Diario de revisiones: {self.pending_rows()} filas pendientes recuperadas.")
+
+    def append(self, rows, value_input_option='RAW'):
+        """Guarda filas en el diario. Vuelve en cuanto están en disco."""
+        if not rows:
+            return
+        entry = {"ts": _time.time(), "opt": value_input_option, "rows": rows}
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+        with self._lock:
+            self._fh.write(line)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._pending.append((self._fh.tell(), entry))
+
+    def pending_rows(self):
+        with self._lock:
+            return sum(len(entry["rows"]) for _, entry in self._pending)
+
+    def lag(self):
+        """Filas pendientes y antigüedad (s) de la más vieja."""
+        with self._lock:
+            rows = sum(len(entry["rows"]) for _, entry in self._pending)
+            oldest = self._pending[0][1]["ts"] if self._pending else None
+        return {
+            "pending_rows": rows,
+            "oldest_age_seconds": round(_time.time() - oldest, 1) if oldest else 0.0,
+        }
+
+    def flush(self, sheet, max_rows=JOURNAL_BATCH_ROWS):
+        """Escribe en la hoja hasta `max_rows` filas pendientes. Devuelve cuántas."""
+        with self._lock:
+            batch = []
+            count = 0
+            for item in self._pending:
+                batch.append(item)
+                count += len(item[1]["rows"])
+                if count >= max_rows:
+                    break
+        if not batch:
+            return 0
+
+        # Tramos consecutivos con la misma opción de entrada y el mismo formato: una
+        # llamada por tramo y el offset avanza tras cada una para no duplicar filas si algo falla.
+        written = 0
+        start = 0
+        while start < len(batch):
+            kind = self._kind(batch[start][1])
+            end = start
+            rows = []
+            while end < len(batch) and self._kind(batch[end][1]) == kind:
+                rows.extend(batch[end][1]["rows"])
+                end += 1
+
+            sheet.append_rows(rows, value_input_option=kind[0])
+
+            with self._lock:
+                self._write_offset(batch[end - 1][0])
+                del self._pending[:end - start]
+            written += len(rows)
+            start = end
+
+        self.flushed_rows += written
+        self.last_flush_at = _time.time()
+        self._compact()
+        return written
+
+    @staticmethod
+    def _kind(entry):
+        # Filas largas y registros anchos van a pestañas distintas: nunca en la misma llamada
+        return entry["opt"], isinstance(entry["rows"][0], dict)
+
+    def _compact(self):
+        # Si no queda nada pendiente se vacía el fichero para que no crezca sin fin
+        with self._lock:
+            if self._pending or self._offset < 1024 * 1024:
+                return
+            self._fh.truncate(0)
+            self._fh.seek(0)
+            self._write_offset(0)
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+
+class ChatRegistry:
+    """@usuario -> chat_id de cada atleta que ha hablado con el bot, guardado en disco.
+
+    La hoja `Users` solo tiene el @usuario y Telegram exige el chat_id para
+    escribir a alguien por iniciativa del bot (el envío semanal).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._chats = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._chats = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    def get(self, telegram_id):
+        return self._chats.get(telegram_id)
+
+    def record(self, telegram_id, chat_id):
+        if self._chats.get(telegram_id) == chat_id:
+            return
+        self._chats[telegram_id] = chat_id
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._chats, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self._chats)
+
+
+_NUMBER_RE = re.compile(r"-?\d+(?:[.,]\d+)?")
+
+def parse_measure(answer):
+    """Primer número de una respuesta ("82,5 cm" -> 82.5). None si no es una medida."""
+    answer = str(answer).strip()
+    # Las filas de fotos llevan una fórmula =IMAGE(...) con números que no son medidas
+    if answer.startswith("="):
+        return None
+    match = _NUMBER_RE.search(answer)
+    return float(match.group().replace(",", ".")) if match else None
+
+def summarize_measure(days, values, rolling_weeks=PROGRESS_ROLLING_WEEKS, trend_weeks=PROGRESS_TREND_WEEKS):
+    """Serie semanal, media móvil, variación semanal y pendiente de una medida.
+
+    `days` son ordinales de fecha. Si hay varias respuestas en la misma semana
+    cuenta la última.
+    """
+    days = np.asarray(days, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    order = np.argsort(days, kind="stable")
+    days, values = days[order], values[order]
+
+    # Semanas de lunes a domingo (el ordinal 1 es lunes)
+    weeks = (days - 1) // 7
+    last_of_week = np.r_[weeks[1:] != weeks[:-1], True]
+    weeks, days, values = weeks[last_of_week], days[last_of_week], values[last_of_week]
+
+    # Media móvil con sumas acumuladas (ventana más corta al principio de la serie)
+    n = len(values)
+    cumsum = np.r_[0.0, np.cumsum(values)]
+    idx = np.arange(n)
+    start = np.maximum(0, idx + 1 - rolling_weeks)
+    rolling = (cumsum[idx + 1] - cumsum[start]) / (idx + 1 - start)
+
+    # Variación por semana (si falta alguna semana se reparte el cambio entre ellas)
+    deltas = np.diff(values) / np.diff(weeks) if n > 1 else np.empty(0)
+
+    recent = weeks >= weeks[-1] - trend_weeks + 1
+    slope = float(np.polyfit(weeks[recent], values[recent], 1)[0]) if recent.sum() > 1 else None
+
+    return {
+        "days": days.tolist(),
+        "values": values.tolist(),
+        "rolling": rolling.tolist(),
+        "last": float(values[-1]),
+        "delta": float(deltas[-1]) if len(deltas) else None,
+        "slope": slope,
+    }
+
+def render_progress_chart(title, series):
+    """PNG con una gráfica por medida. Se ejecuta en el pool de procesos."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    cols = min(3, len(series))
+    rows = (len(series) + cols - 1) // cols
+    fig, axes = plt.subplots(rows, cols, figsize=(4 * cols, 2.8 * rows), squeeze=False)
+    for ax, (name, summary) in zip(axes.flat, series):
+        dates = [datetime.fromordinal(d) for d in summary["days"]]
+        ax.plot(dates, summary["values"], "o-", color="#2e7d32", markersize=3, linewidth=1)
+        ax.plot(dates, summary["rolling"], "--", color="#9e9e9e", linewidth=1)
+        ax.set_title(name, fontsize=9)
+        ax.tick_params(labelsize=7)
+        ax.xaxis.set_major_formatter(mdates.DateFormatter("%d/%m"))
+    for ax in list(axes.flat)[len(series):]:
+        ax.axis("off")
+    fig.suptitle(title, fontsize=11)
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=110)
+    plt.close(fig)
+    return buffer.getvalue()
+
+def read_revision_rows(sheet, first_row, last_row):
+    """Filas `first_row`..`last_row` de `Revisiones` (1 = encabezados). Las vacías del final no vienen."""
+    return sheet.get(f"A{first_row}:E{last_row}")
+
+def read_sheet_rows(sheet, first_row, last_row):
+    """Filas completas `first_row`..`last_row` de una pestaña (todas sus columnas)."""
+    return sheet.get(f"{first_row}:{last_row}")
+
+
+class AthleteProgress:
+    """Medidas de un atleta y sus resúmenes, recalculados solo si llegan datos nuevos."""
+
+    __slots__ = ("points", "summaries", "dirty", "version", "chart", "chart_version", "last_row")
+
+    def __init__(self):
+        self.last_row = 0
+        self.points = {}  # pregunta -> ([días], [valores])
+        self.summaries = {}
+        self.dirty = set()
+        self.version = 0
+        self.chart = None
+        self.chart_version = None
+
+    def add(self, question, day, value):
+        days, values = self.points.setdefault(question, ([], []))
+        days.append(day)
+        values.append(value)
+        self.dirty.add(question)
+        self.version += 1
+
+    def summary(self):
+        for question in self.dirty:
+            days, values = self.points[question]
+            self.summaries[question] = summarize_measure(days, values)
+        self.dirty.clear()
+        return self.summaries
+
+
+class ProgressTracker:
+    """Agregados de /progreso por atleta a partir del espejo local de `Revisiones`.
+
+    Cada atleta recuerda la última fila procesada y solo se leen del espejo
+    sus filas posteriores. Los resúmenes y la gráfica se rehacen solo cuando
+    tiene medidas nuevas.
+    """
+
+    def __init__(self):
+        self._athletes = {}
+
+    def update(self, telegram_id):
+        athlete = self._athletes.setdefault(telegram_id, AthleteProgress())
+        for row, nombre, fecha, _, pregunta, respuesta in sheet_mirror.revisions(telegram_id, after_row=athlete.last_row):
+            athlete.last_row = row
+            if pregunta == PHOTO_QUESTION:
+                continue
+            value = parse_measure(respuesta)
+            if value is None:
+                continue
+            try:
+                day = datetime.strptime(fecha, "%Y-%m-%d").toordinal()
+            except ValueError:
+                continue
+            athlete.add(pregunta, day, value)
+        return athlete
+
+progress = ProgressTracker()
+
+
+class SheetMirror:
+    """Copia local (SQLite) de `Revisiones` y `Users` para consultas del bot.
+
+    Las revisiones solo crecen, así que se sincronizan de forma incremental:
+    se guarda la siguiente fila por leer y cada sincronización pide a Sheets
+    solo los rangos nuevos, en trozos de `chunk_rows` filas. En formato ancho
+    se lee la pestaña ancha y cada fila se despliega en filas largas (una por
+    columna con valor), así que las consultas son las mismas en los dos
+    formatos. Las filas se indexan por atleta y fecha. `Users` se copia entera
+    cada vez que se recarga el directorio de usuarios. La hoja sigue siendo lo
+    que ve el entrenador.
+    """
+
+    def __init__(self, path, wide=None, chunk_rows=MIRROR_CHUNK_ROWS, max_age=MIRROR_SYNC_SECONDS,
+                 recheck_rows=MIRROR_RECHECK_ROWS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.wide = REVISION_FORMAT == "wide" if wide is None else wide
+        self.source = "wide" if self.wide else "long"
+        self.chunk_rows = chunk_rows
+        self.max_age = max_age
+        self.recheck_rows = recheck_rows
+        self.synced_at = None
+        self._lock = asyncio.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(revisions)")}
+        if columns and "source" not in columns:
+            # Espejo de una versión anterior (sin origen): se reconstruye desde Sheets
+            self._db.execute("DROP TABLE revisions")
+            self._db.execute("DELETE FROM meta")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS revisions ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT, sheet_row INTEGER, col INTEGER, "
+            "nombre TEXT, fecha TEXT, telegram_id TEXT, pregunta TEXT, respuesta TEXT, "
+            "UNIQUE (source, sheet_row, col))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS revisions_athlete_date ON revisions (telegram_id, fecha)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS revisions_date ON revisions (fecha)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS users (telegram_id TEXT PRIMARY KEY, nombre TEXT)")
+
+        # Al cambiar de formato cambia la hoja de origen y lo copiado del otro saldría repetido
+        stored = self._meta("source")
+        if stored is not None and stored != self.source:
+            self._db.execute("DELETE FROM revisions")
+            self._db.execute("DELETE FROM meta WHERE key = 'next_row'")
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source', ?)", (self.source,))
+
+    def _meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def next_row(self):
+        return int(self._meta("next_row") or 2)
+
+    def is_stale(self):
+        return self.synced_at is None or monotonic() - self.synced_at >= self.max_age
+
+    async def sync(self, sheet):
+        """Trae de Sheets las filas añadidas desde la última vez. Devuelve cuántas."""
+        async with self._lock:
+            first = self.next_row
+            header = None
+            start = first
+            if self.wide:
+                # Las fotos se añaden a la fila de su revisión: las celdas nuevas de filas
+                # recientes entran como (fila, columna) nuevas y el resto se ignora
+                start = max(2, first - self.recheck_rows)
+            while True:
+                end = start + self.chunk_rows - 1
+                if self.wide:
+                    rows = await google_io.sheets("sheet_read", read_sheet_rows, sheet, start, end)
+                    if rows and header is None:
+                        header = await google_io.sheets("sheet_read", sheet.row_values, 1)
+                    records = self._explode(start, header, rows)
+                else:
+                    rows = await google_io.sheets("sheet_read", read_revision_rows, sheet, start, end)
+                    records = [(start + offset, 0, *(list(map(str, row)) + [""] * 5)[:5])
+                               for offset, row in enumerate(rows) if any(row)]
+                self._store(start + len(rows), records)
+                if len(rows) < self.chunk_rows:
+                    break
+                start = self.next_row
+            self.synced_at = monotonic()
+            return max(0, self.next_row - first)
+
+    def _explode(self, start, header, rows):
+        """Filas anchas -> (fila, columna, nombre, fecha, @usuario, pregunta, respuesta)."""
+        records = []
+        fixed = len(WIDE_REVISION_HEADERS)
+        for offset, row in enumerate(rows):
+            if not any(row):
+                continue
+            _, nombre, fecha, telegram_id = (list(map(str, row)) + [""] * fixed)[:fixed]
+            for col in range(fixed, len(row)):
+                if row[col] == "":
+                    continue
+                pregunta = column_label(header[col]) if col < len(header) else f"Columna {col + 1}"
+                records.append((start + offset, col, nombre, fecha, telegram_id, pregunta, str(row[col])))
+        return records
+
+    def _store(self, next_row, records):
+        # Puede haber otro proceso sincronizando el mismo fichero: filas y cursor en la misma transacción
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO revisions (source, sheet_row, col, nombre, fecha, telegram_id, pregunta, respuesta) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(self.source, *r) for r in records]
+            )
+            self._db.execute(
+                "INSERT INTO meta (key, value) VALUES ('next_row', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                (next_row,)
+            )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def replace_users(self, users):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("DELETE FROM users")
+            self._db.executemany("INSERT OR REPLACE INTO users (telegram_id, nombre) VALUES (?, ?)",
+                                 [(u.telegram_id, u.nombre) for u in users])
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def revisions(self, telegram_id=None, after_row=0, since=None):
+        """Filas (id, nombre, fecha, @usuario, pregunta, respuesta) en orden de llegada."""
+        query = "SELECT id, nombre, fecha, telegram_id, pregunta, respuesta FROM revisions WHERE id > ?"
+        params = [after_row]
+        if telegram_id is not None:
+            query += " AND telegram_id = ?"
+            params.append(telegram_id)
+        if since is not None:
+            query += " AND fecha >= ?"
+            params.append(since)
+        return self._db.execute(query + " ORDER BY id", params).fetchall()
+
+    def users(self):
+        return [User(nombre=n, telegram_id=t) for t, n in self._db.execute("SELECT telegram_id, nombre FROM users ORDER BY nombre")]
+
+    def close(self):
+        self._db.close()
+
+
+def init_sheet_mirror(path=None):
+    global sheet_mirror
+    if sheet_mirror is None:
+        sheet_mirror = SheetMirror(path or os.path.join(DATA_DIR, "mirror.db"))
+    return sheet_mirror
+
+async def mirror_sync_job(context):
+    try:
+        added = await sheet_mirror.sync(google_clients.current_revision_ws())
+    except Exception as e:
+        logging.warning(f"No se pudo sincronizar el espejo local de Revisiones: {e}")
+        return
+    if added:
+        logging.info(f"Espejo local: {added} filas nuevas de Revisiones.")
+
+async def ensure_mirror_fresh():
+    # Si Sheets falla se responde con lo que ya hay en local
+    if sheet_mirror.is_stale():
+        await mirror_sync_job(None)
+
+def init_known_chats(path=None):
+    global known_chats
+    if known_chats is None:
+        known_chats = ChatRegistry(path or os.path.join(DATA_DIR, "chats.json"))
+    return known_chats
+
+async def record_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Se apunta el chat privado de cada usuario para el envío semanal
+    chat = update.effective_chat
+    user = update.effective_user
+    if chat is not None and user is not None and chat.type == "private":
+        known_chats.record(user.name, chat.id)
+
+class IdempotencyStore:
+    """Trabajo ya hecho, para no repetirlo: updates procesados y fotos subidas (SQLite).
+
+    Los update_id vistos se guardan en disco durante `retention` segundos y
+    los más recientes también en memoria (como mucho `memory`), así que una
+    reentrega de Telegram se descarta sin tocar el disco en el caso habitual.
+    Las fotos se indexan por `file_unique_id` de Telegram y por el SHA-256 del
+    fichero original: si vuelven a llegar se reutiliza lo que ya está en Drive.
+    """
+
+    def __init__(self, path, memory=SEEN_UPDATES_MEMORY, retention=SEEN_UPDATES_RETENTION_SECONDS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.memory = memory
+        self.retention = retention
+        self._recent = OrderedDict()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS seen_updates (update_id INTEGER PRIMARY KEY, seen_at REAL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS photos ("
+            "file_unique_id TEXT PRIMARY KEY, sha256 TEXT, drive_id TEXT, thumb_id TEXT, thumb_link TEXT, created_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS photos_sha256 ON photos (sha256)")
+
+    def seen(self, update_id):
+        """Marca el update como visto. Devuelve True si ya lo estaba."""
+        if update_id in self._recent:
+            self._recent.move_to_end(update_id)
+            return True
+        # INSERT OR IGNORE es atómico aunque haya varios procesos sobre el mismo fichero
+        cursor = self._db.execute(
+            "INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?)", (update_id, _time.time())
+        )
+        self._recent[update_id] = None
+        if len(self._recent) > self.memory:
+            self._recent.popitem(last=False)
+        return cursor.rowcount == 0
+
+    def prune(self):
+        cursor = self._db.execute("DELETE FROM seen_updates WHERE seen_at < ?", (_time.time() - self.retention,))
+        return cursor.rowcount
+
+    def photo(self, file_unique_id=None, sha256=None):
+        """Fichero de Drive ya subido para esa foto (por id de Telegram o por contenido)."""
+        if file_unique_id is not None:
+            row = self._db.execute(
+                "SELECT drive_id, thumb_id, thumb_link, sha256 FROM photos WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+        else:
+            row = self._db.execute(
+                "SELECT drive_id, thumb_id, thumb_link, sha256 FROM photos WHERE sha256 = ? LIMIT 1", (sha256,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "thumb_id": row[1], "thumb_link": row[2], "sha256": row[3]}
+
+    def record_photo(self, file_unique_id, sha256, drive_id, thumb_id, thumb_link):
+        self._db.execute(
+            "INSERT OR REPLACE INTO photos (file_unique_id, sha256, drive_id, thumb_id, thumb_link, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (file_unique_id, sha256, drive_id, thumb_id, thumb_link, _time.time())
+        )
 
-    # 2) Preparar datos
-    nombre = user_data[telegram_username]["name"]
-    respuestas = user_data[telegram_username]["answers"]
+    def close(self):
+        self._db.close()
+
+
+def init_idempotency(path=None):
+    global idempotency
+    if idempotency is None:
+        idempotency = IdempotencyStore(path or os.path.join(DATA_DIR, "idempotency.db"))
+    return idempotency
+
+async def drop_duplicate_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Antes que ningún otro handler: una reentrega de Telegram no se procesa dos veces
+    if idempotency.seen(update.update_id):
+        metrics.inc("bot_duplicate_updates_total")
+        raise ApplicationHandlerStop
+
+async def prune_seen_updates_job(context):
+    pruned = idempotency.prune()
+    if pruned:
+        logging.info(f"{pruned} update_id antiguos eliminados del registro de duplicados.")
+
+def init_sessions(path=None):
+    global sessions
+    if sessions is None:
+        sessions = SessionStore(path or os.path.join(DATA_DIR, "sessions.db"))
+    return sessions
+
+async def evict_sessions_job(context):
+    evicted = sessions.evict_idle()
+    if evicted:
+        logging.info(f"{evicted} sesiones inactivas fuera de memoria ({len(sessions)} activas).")
+
+def init_drive_folders(path=None):
+    global drive_folders
+    if drive_folders is None:
+        drive_folders = DriveFolderCache(path or os.path.join(DATA_DIR, "drive_folders.json"))
+    return drive_folders
+
+def init_revision_journal(path=None):
+    global revision_journal
+    if revision_journal is None:
+        revision_journal = RevisionJournal(path or os.path.join(DATA_DIR, "revisiones.journal"))
+    return revision_journal
+
+_IMAGE_URL_RE = re.compile(r'=IMAGE\("([^"]+)"')
+
+def migrate_revisions_to_wide(batch_rows=1000):
+    """Convierte el histórico de `Revisiones` al formato ancho, por lotes.
+
+    Uso único antes de pasar a BOT_REVISION_FORMAT=wide:
+
+        python ScriptBot.py migrar-revisiones
+
+    Las respuestas de un mismo atleta y día forman una revisión (si se repite
+    una pregunta empieza otra) y cada =IMAGE(...) pasa a ser un enlace en una
+    columna de foto. La hoja larga no se modifica. Si se corta (cuota, red)
+    se puede volver a lanzar: las revisiones ya escritas se saltan.
+    """
+    init_google_clients()
+    return asyncio.run(_migrate_revisions_to_wide(batch_rows))
+
+async def _migrate_revisions_to_wide(batch_rows):
+    long_ws = google_clients.revision_ws
+    wide_ws = google_clients.wide_revision_ws
+    done = {r for r in (await google_io.sheets("sheet_read", wide_ws.col_values, 1))[1:] if r}
+    if any(not r.startswith(MIGRATED_REVISION_PREFIX) for r in done):
+        raise SystemExit(f"La pestaña {WIDE_REVISION_WORKSHEET_NAME} ya tiene revisiones del bot: vacíala antes de migrar.")
+
+    records = []
+    open_records = {}  # (@usuario, fecha) -> revisión que se está rellenando
+    start = 2
+    while True:
+        rows = await google_io.sheets("sheet_read", long_ws.get, f"A{start}:E{start + batch_rows - 1}",
+                                      value_render_option=ValueRenderOption.formula)
+        for offset, row in enumerate(rows):
+            if len(row) < 5 or not any(row):
+                continue
+            nombre, fecha, telegram_id, pregunta, respuesta = (str(v) for v in row[:5])
+            key = (telegram_id, fecha)
+            record = open_records.get(key)
+            qid = None if pregunta == PHOTO_QUESTION else question_id(pregunta)
+            if record is None or (qid is not None and qid in record):
+                # El id sale de la fila donde empieza la revisión: es el mismo en cada intento
+                record = new_wide_revision(nombre, telegram_id, fecha,
+                                           revision_id=f"{MIGRATED_REVISION_PREFIX}{start + offset}")
+                records.append(record)
+                open_records[key] = record
+            if qid is None:
+                match = _IMAGE_URL_RE.search(respuesta)
+                add_photo_links(record, [match.group(1) if match else respuesta])
+            else:
+                record[qid] = respuesta
+        logging.info(f"Leídas {start + len(rows) - 2} filas de Revisiones ({len(records)} revisiones).")
+        start += len(rows)
+        if len(rows) < batch_rows:
+            break
+
+    pending = [r for r in records if r["Revision"] not in done]
+    if done:
+        logging.info(f"{len(records) - len(pending)} revisiones ya estaban migradas, se sigue con las {len(pending)} restantes.")
+
+    # Cada lote es una sola escritura: si falla no queda a medias y el siguiente intento lo repite
+    sheet = RevisionSheet(google_clients)
+    for i in range(0, len(pending), batch_rows):
+        await google_io.sheets_calls("sheet_append", sheet, sheet.append_rows, pending[i:i + batch_rows])
+        logging.info(f"Escritas {min(i + batch_rows, len(pending))} de {len(pending)} revisiones.")
+    return len(pending)
+
+def init_revision_sheet():
+    global revision_sheet
+    if revision_sheet is None:
+        revision_sheet = RevisionSheet(google_clients)
+    return revision_sheet
+
+async def flush_journal_job(context):
+    try:
+        await google_io.sheets_calls("sheet_append", revision_sheet, revision_journal.flush, revision_sheet)
+    except Exception as e:
+        logging.warning(f"No se pudieron volcar las revisiones a Sheets, se reintentará: {e}")
+
+async def save_user_data(telegram_username):
+    # 1) Preparar datos
+    session = sessions.get(telegram_username)
+    nombre = session.name
+    respuestas = session.answers
+    # Las preguntas de la versión que vio el atleta, aunque la hoja haya cambiado después
+    preguntas = session_questions(session)
     fecha_hoy = datetime.now().strftime("%Y-%m-%d")
 
-    # 3) Insertar una fila por cada respuesta
+    # En formato ancho toda la revisión es una sola fila; se devuelve su id
+    # para que las fotos que lleguen después se añadan a esa misma fila
+    if REVISION_FORMAT == "wide":
+        record = build_wide_revision(session)
+        revision_journal.append([record])
+        return record["Revision"]
+
+    # 2) Una fila por respuesta. Van al diario local y el flusher las
+    #    escribe en `Revisiones` agrupadas con las de otros atletas.
+    rows = []
     for idx, respuesta in enumerate(respuestas):
-        pregunta = Questions[idx] if idx < len(Questions) else f"Pregunta {idx+1}"
-        row = [nombre, fecha_hoy, telegram_username, pregunta, respuesta]
-        sheet.append_row(row)
+        pregunta = preguntas[idx] if idx < len(preguntas) else f"Pregunta {idx+1}"
+        rows.append([nombre, fecha_hoy, telegram_username, pregunta, respuesta])
+
+    revision_journal.append(rows)
 
 # Callback para /Revision
+@instrumented("revision_command")
 async def revision_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔄 Lanzando revisión de seguimiento ahora mismo…")
     # Reusar la función que ya programa la tarea mensual
     #Primero buscamos al usuario dentro de la lista de usuarios habilitados
-    ActiveUsers = readActiveUsers()
-
-    found_user = next((u for u in ActiveUsers if u.telegram_id == update.message.from_user.name), None)
+    found_user = users_directory.get(update.message.from_user.name)
 
     if found_user:
-        await send_questions_to_user(found_user, update, context, Questions)
+        try:
+            await send_questions_to_user(found_user, update.message.chat_id, context.bot.send_message, question_catalog.current)
+        except Exception as e:
+            logging.warning(f"Error al enviar mensajes a {found_user.telegram_id}: {e}")
     else:
         await context.bot.send_message(
             chat_id=update.message.chat_id,
             text="No estás en la lista de usuarios activos."
         )
 
+@instrumented("info_command")
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mensaje = (
         "👋 *Bienvenido/a a tu asistente de revisiones nutricionales*\n\n"
@@ -474,32 +2314,24 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await update.message.reply_text(mensaje, parse_mode="Markdown")
 
+@instrumented("fotos_command")
 async def fotos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.name
     user_name = update.message.from_user.full_name
 
-    # Asegurar usuarios activos en memoria
-    ActiveUsers = readActiveUsers()
-    for user in ActiveUsers:
-        if user.telegram_id not in user_data:
-            user_data[user.telegram_id] = {
-                "name": user.nombre,
-                "step": None,
-                "current_q": 0,
-                "answers": []
-            }
-
     # Verificar autorización
-    if user_id not in user_data:
+    session = get_user_state(user_id)
+    if session is None:
         await update.message.reply_text(
             "❌ Tu usuario no está habilitado para subir fotos."
         )
         return
 
     # Activar modo subida manual de fotos
-    user_data[user_id]["step"] = "upload_photos"
-    user_data[user_id]["current_q"] = None
-    user_data[user_id]["name"] = user_name
+    session.step = "upload_photos"
+    session.current_q = None
+    session.name = user_name
+    sessions.save(session)
 
     await update.message.reply_text(
         "📸 *Subida manual de fotos activada*\n\n"
@@ -509,19 +2341,332 @@ async def fotos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode="Markdown"
     )
 
+@instrumented("reload_users_command")
+async def reload_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.name not in BOT_ADMINS:
+        await update.message.reply_text("❌ Este comando está reservado a administradores.")
+        return
+
+    if await users_directory.refresh_async():
+        await update.message.reply_text(f"🔄 Usuarios recargados: {len(users_directory)} activos.")
+    else:
+        await update.message.reply_text(
+            "⚠️ No se pudo leer la hoja de usuarios. Se mantiene la última copia cargada."
+        )
+
+def _format_change(value):
+    return "—" if value is None else f"{value:+.1f}"
+
+@instrumented("progreso_command")
+async def progreso_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.message.from_user.name
+    found_user = users_directory.get(user_id)
+    if found_user is None:
+        await update.message.reply_text("❌ Tu usuario no está habilitado.")
+        return
+
+    await ensure_mirror_fresh()
+    athlete = progress.update(user_id)
+    summaries = athlete.summary()
+    if not summaries:
+        await update.message.reply_text("Todavía no hay medidas guardadas para mostrar tu progreso.")
+        return
+
+    lines = [f"📈 Progreso de {found_user.nombre}",
+             f"(último · cambio semanal · media {PROGRESS_ROLLING_WEEKS} sem · tendencia/sem)", ""]
+    for question, summary in summaries.items():
+        lines.append(
+            f"• {question}: {summary['last']:g} · {_format_change(summary['delta'])} · "
+            f"{summary['rolling'][-1]:.1f} · {_format_change(summary['slope'])}"
+        )
+    await update.message.reply_text("\n".join(lines))
+
+    # La gráfica se dibuja en el pool de procesos y se reutiliza hasta que haya medidas nuevas
+    series = [(q, s) for q, s in summaries.items() if len(s["values"]) > 1]
+    if not series:
+        return
+    if athlete.chart_version != athlete.version:
+        loop = asyncio.get_running_loop()
+        athlete.chart = await loop.run_in_executor(get_image_pool(), render_progress_chart,
+                                                   f"Progreso de {found_user.nombre}", series)
+        athlete.chart_version = athlete.version
+    await context.bot.send_photo(chat_id=update.message.chat_id, photo=athlete.chart)
+
+@instrumented("exportar_command")
+async def exportar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.name not in BOT_ADMINS:
+        await update.message.reply_text("❌ Este comando está reservado a administradores.")
+        return
+
+    # /exportar [@usuario] [AAAA-MM-DD]: historial de un atleta (o de todos) desde una fecha
+    telegram_id = next((a for a in context.args if a.startswith("@")), None)
+    since = next((a for a in context.args if not a.startswith("@")), None)
+    await ensure_mirror_fresh()
+    rows = sheet_mirror.revisions(telegram_id, since=since)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(REVISION_HEADERS)
+    writer.writerows(row[1:] for row in rows)
+    filename = f"revisiones-{(telegram_id or 'todos').lstrip('@')}.csv"
+    await context.bot.send_document(chat_id=update.message.chat_id, document=buffer.getvalue().encode("utf-8"),
+                                    filename=filename, caption=f"{len(rows)} filas")
+
+def _format_ms(seconds):
+    return "∞" if seconds == float("inf") else f"{seconds * 1000:.0f} ms"
+
+@instrumented("stats_command")
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.name not in BOT_ADMINS:
+        await update.message.reply_text("❌ Este comando está reservado a administradores.")
+        return
+
+    lines = ["📊 Estadísticas del bot", "", "Handlers (llamadas · media · p50 · p99):"]
+    for key, (total, mean, p50, p99) in sorted(metrics.histogram_summary("bot_handler_seconds").items()):
+        name = dict(key)["handler"]
+        errors = metrics.counter_value("bot_handler_errors_total", handler=name)
+        lines.append(f"• {name}: {total} · {_format_ms(mean)} · ≤{_format_ms(p50)} · ≤{_format_ms(p99)} · {errors} errores")
+
+    lines += ["", "Google (llamadas · media · p99):"]
+    for key, (total, mean, p50, p99) in sorted(metrics.histogram_summary("bot_google_call_seconds").items()):
+        labels = dict(key)
+        errors = metrics.counter_value("bot_google_errors_total", **labels)
+        lines.append(f"• {labels['api']}/{labels['op']}: {total} · {_format_ms(mean)} · ≤{_format_ms(p99)} · {errors} errores")
+
+    lag = revision_journal.lag()
+    lines += [
+        "",
+        f"Revisiones pendientes: {lag['pending_rows']} filas (la más antigua hace {lag['oldest_age_seconds']}s)",
+        f"Updates en cola: {context.application.update_queue.qsize()}",
+    ]
+    processor = context.application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        lines.append(f"Updates en curso: {processor.running} (esperando turno: {processor.waiting})")
+    lines += [
+        f"Álbumes en espera: {len(pending_albums)}",
+        f"Sesiones en memoria: {len(sessions)}",
+    ]
+    await update.message.reply_text("\n".join(lines))
+
 async def status_logger():
     while True:
-        print("⌛ Aplicación en ejecución. Esperando mensajes de Telegram...")
+        lag = revision_journal.lag()
+        print(
+            "⌛ Aplicación en ejecución. Esperando mensajes de Telegram... "
+            f"(revisiones pendientes: {lag['pending_rows']} filas, la más antigua hace {lag['oldest_age_seconds']}s)"
+        )
         await asyncio.sleep(10)
 
+async def serve_metrics(host, port):
+    """Servidor HTTP mínimo que solo responde GET /metrics (formato de Prometheus)."""
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Se descartan las cabeceras
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", metrics.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Updates de usuarios distintos a la vez y los de un mismo usuario en orden.
+
+    Cada usuario tiene su cerrojo (FIFO): su siguiente update no empieza hasta
+    que termina el anterior, así que el flujo de `handle_text` (leer la
+    sesión, guardar la respuesta, avanzar de pregunta) nunca se solapa
+    consigo mismo. Como mucho `max_in_flight` updates se ejecutan a la vez;
+    el cupo se toma ya con el turno del usuario, de modo que quien tiene
+    mensajes en cola no ocupa huecos de los demás. Si un usuario acumula más
+    de `max_pending` updates sin procesar, los nuevos se descartan.
+
+    En modo webhook `run_application` deja de sacar updates de su cola acotada
+    mientras el procesador está saturado (`wait_for_room`), así que es esa
+    cola la que se llena y el webhook responde 503.
+    """
+
+    def __init__(self, max_in_flight=UPDATES_MAX_IN_FLIGHT, max_pending=UPDATES_MAX_PENDING_PER_USER):
+        # El semáforo de la clase base acota los que esperan más los que corren
+        self.capacity = max_in_flight * (max_pending + 1)
+        super().__init__(self.capacity)
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._users = {}  # usuario -> [cerrojo, updates pendientes]
+        self._room = asyncio.Event()
+        self.running = 0
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return ("chat", update.effective_chat.id)
+        return None
+
+    @property
+    def waiting(self):
+        return sum(pending for _, pending in self._users.values()) - self.running
+
+    def saturated(self, backlog=0):
+        """Todos los huecos ocupados, o tantos updates recibidos (más `backlog` por llegar) como caben."""
+        return (self.running >= self.max_in_flight
+                or self.current_concurrent_updates + backlog >= self.capacity)
+
+    async def wait_for_room(self, backlog=lambda: 0):
+        while self.saturated(backlog()):
+            self._room.clear()
+            await self._room.wait()
+
+    async def do_process_update(self, update, coroutine):
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self._room.set()
+
+    async def _process(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._in_flight:
+                await coroutine
+            return
+
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        if entry[1] >= self.max_pending:
+            metrics.inc("bot_updates_dropped_total")
+            logging.warning(f"Update {getattr(update, 'update_id', '?')} descartado: el usuario {key} ya tiene {entry[1]} en espera.")
+            coroutine.close()
+            return
+
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._in_flight:
+                    self.running += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+        finally:
+            entry[1] -= 1
+            # Sin pendientes ya nadie usa el cerrojo: memoria proporcional a los usuarios activos
+            if entry[1] == 0:
+                del self._users[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def register_gauges(application):
+    metrics.gauge("bot_revision_journal_pending_rows", lambda: revision_journal.lag()["pending_rows"],
+                  "Filas de revisiones en el diario pendientes de escribir en Sheets.")
+    metrics.gauge("bot_revision_journal_oldest_age_seconds", lambda: revision_journal.lag()["oldest_age_seconds"],
+                  "Antigüedad de la fila pendiente más vieja del diario.")
+    metrics.gauge("bot_update_queue_depth", lambda: application.update_queue.qsize(),
+                  "Updates de Telegram esperando a ser procesados.")
+    processor = application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        metrics.gauge("bot_updates_running", lambda: processor.running,
+                      "Updates ejecutándose ahora mismo.")
+        metrics.gauge("bot_updates_waiting", lambda: processor.waiting,
+                      "Updates esperando a que termine el anterior del mismo usuario o a un hueco libre.")
+    metrics.gauge("bot_pending_albums", lambda: len(pending_albums),
+                  "Álbumes de fotos esperando a completarse.")
+    metrics.gauge("bot_active_sessions", lambda: len(sessions),
+                  "Sesiones de conversación en memoria.")
+
 async def post_init(application):
     asyncio.create_task(status_logger())
 
-def main():
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    register_gauges(application)
+    if METRICS_PORT:
+        try:
+            application.bot_data["metrics_server"] = await serve_metrics(METRICS_HOST, METRICS_PORT)
+            logging.info(f"📈 Métricas en http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logging.warning(f"No se pudo abrir el puerto de métricas {METRICS_PORT}: {e}")
 
-    app = ApplicationBuilder().token("7718801957:AAEiQmiAqhWhMuZQ0rOR1VbU5ZUph24_E7E").post_init(post_init).build()
+    # Una sola lista de la carpeta raíz para precargar las carpetas de los atletas
+    try:
+        await drive_folders.warm(DRIVE_ROOT_FOLDER_ID)
+    except Exception as e:
+        logging.warning(f"No se pudo precargar la caché de carpetas de Drive: {e}")
 
+async def post_shutdown(application):
+    # Último volcado antes de salir; lo que no entre se reenvía al arrancar
+    try:
+        while revision_journal.flush(revision_sheet):
+            pass
+    except Exception as e:
+        logging.warning(f"Quedan revisiones pendientes en el diario: {e}")
+    revision_journal.close()
+    sessions.close()
+    idempotency.close()
+    sheet_mirror.close()
+    google_io.shutdown()
+    if image_pool is not None:
+        image_pool.shutdown()
+    server = application.bot_data.get("metrics_server")
+    if server is not None:
+        server.close()
+
+def init_bot_state():
+    """Carga todo lo que necesita un proceso del bot antes de atender updates."""
+    global question_catalog
+    # Los clientes de Google se crean una sola vez y se comparten
+    init_google_clients()
+    init_sheet_mirror()
+    if not users_directory.refresh():
+        # Sin la hoja `Users` se arranca con la última copia guardada en el espejo local
+        users_directory.load_fallback(sheet_mirror.users())
+        logging.warning(f"Usando {len(users_directory)} usuarios del espejo local hasta poder leer la hoja.")
+    init_revision_journal()
+    init_revision_sheet()
+    init_drive_folders()
+    init_known_chats()
+    init_sessions()
+    init_idempotency()
+    # Las preguntas deben cargarse antes de lanzar el bot; si Drive o Sheets fallan
+    # se arranca con la última versión guardada y el job de refresco lo reintenta
+    question_catalog = QuestionCatalog(os.path.join(DATA_DIR, "questions.json"))
+    try:
+        version = questions_modified_time(google_clients.drive)
+        if question_catalog.current is None or version != question_catalog.current.version:
+            question_catalog.publish(version, readQuestions())
+    except Exception as e:
+        if question_catalog.current is None:
+            raise
+        logging.warning(f"No se pudo leer la hoja de preguntas, se arranca con la versión guardada "
+                        f"{question_catalog.current.version}: {e}")
+
+def build_application(webhook=False):
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    # Updates de distintos atletas en paralelo, los de cada atleta en orden
+    builder = builder.concurrent_updates(PerUserUpdateProcessor())
+    if webhook:
+        # En modo webhook los updates los mete nuestro servidor HTTP en la cola
+        builder = builder.updater(None)
+    app = builder.build()
+
+    app.add_handler(TypeHandler(Update, drop_duplicate_updates), group=-2)
+    app.add_handler(TypeHandler(Update, record_chat), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(CommandHandler("revision", revision_command))
@@ -529,18 +2674,244 @@ def main():
     app.add_handler(CommandHandler("info", info_command))
     app.add_handler(CommandHandler("instrucciones", instrucciones_command))
     app.add_handler(CommandHandler("fotos", fotos_command))
+    app.add_handler(CommandHandler("reload_users", reload_users_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("progreso", progreso_command))
+    app.add_handler(CommandHandler("exportar", exportar_command))
 
     # Programar tarea mensual usando el scheduler
     schedule_weekly_tasks(app)
 
+    # Volcado periódico del diario de revisiones a Sheets
+    app.job_queue.run_repeating(flush_journal_job, interval=JOURNAL_FLUSH_SECONDS, first=1, name="flush_revisions")
+
+    # Expulsión de memoria de las sesiones inactivas (siguen guardadas en SQLite)
+    app.job_queue.run_repeating(evict_sessions_job, interval=max(60, SESSION_IDLE_SECONDS // 2), name="evict_sessions")
+
+    # Los update_id vistos hace más de la retención ya no pueden volver a llegar
+    app.job_queue.run_repeating(prune_seen_updates_job, interval=3600, first=60, name="prune_seen_updates")
+
+    # Sincronización incremental del espejo local de `Revisiones`
+    app.job_queue.run_repeating(mirror_sync_job, interval=MIRROR_SYNC_SECONDS, first=5, name="mirror_sync")
+
+    # Recarga en caliente del cuestionario cuando cambia la hoja `Preguntas`
+    app.job_queue.run_repeating(refresh_questions_job, interval=QUESTIONS_CHECK_SECONDS, first=QUESTIONS_CHECK_SECONDS, name="refresh_questions")
+
+    # Refresco en segundo plano del directorio de usuarios
+    # (si al arrancar no se pudo leer la hoja, el primer intento llega enseguida)
+    first = USERS_TTL_SECONDS if users_directory.loaded else 10
+    app.job_queue.run_repeating(refresh_users_job, interval=USERS_TTL_SECONDS, first=first, name="refresh_users")
+
+    return app
+
+def update_chat_id(data):
+    """chat_id de un update en JSON (0 si no tiene), para repartirlo entre workers."""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post", "business_message"):
+        if key in data:
+            return data[key]["chat"]["id"]
+    callback = data.get("callback_query")
+    if callback:
+        message = callback.get("message")
+        return message["chat"]["id"] if message else callback["from"]["id"]
+    for value in data.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return 0
+
+def parse_update(data, bot=None):
+    """Update de Telegram a partir de su JSON, o None si está mal formado."""
+    try:
+        update = Update.de_json(data, bot)
+        update_chat_id(data)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+    return update if isinstance(update.update_id, int) else None
+
+async def serve_webhook(dispatch, queue_depth):
+    """Servidor HTTP del webhook hasta recibir SIGINT/SIGTERM.
+
+    `dispatch(data)` encola el update y devuelve False si la cola está llena
+    (Telegram lo reintentará). Para probar en local basta con hacer POST de un
+    update grabado:
+
+        curl -X POST localhost:8443/telegram -H 'Content-Type: application/json' \\
+             -H 'X-Telegram-Bot-Api-Secret-Token: <secreto>' -d @update.json
+    """
+    # aiohttp solo hace falta en modo webhook
+    from aiohttp import web
+
+    async def handle_update(request):
+        # Sin el secreto cualquiera que llegue al puerto podría inyectar updates (y hacerse pasar por admin)
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Se valida aquí: un update mal formado que llegara al bucle de la aplicación la pararía
+        if parse_update(data) is None:
+            return web.Response(status=400)
+        if not await dispatch(data):
+            return web.Response(status=503)
+        return web.Response()
+
+    async def handle_health(request):
+        return web.json_response(queue_depth())
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, handle_update)
+    web_app.router.add_get("/healthz", handle_health)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    logging.info(f"✅ Webhook escuchando en {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+async def set_webhook(bot):
+    if WEBHOOK_URL:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+
+async def run_application(app, next_update):
+    """Arranca `app` sin updater y le mete los updates que devuelva `next_update()` (None para parar).
+
+    Con el procesador saturado no se saca nada más: los updates se acumulan en
+    la cola acotada de la que lee `next_update` en vez de en `app.update_queue`.
+    """
+    async with app:
+        await app.start()
+        await post_init(app)
+        try:
+            while True:
+                await app.update_processor.wait_for_room(app.update_queue.qsize)
+                data = await next_update()
+                if data is None:
+                    break
+                update = parse_update(data, app.bot)
+                if update is None:
+                    logging.warning("Update mal formado descartado.")
+                    continue
+                await app.update_queue.put(update)
+        finally:
+            await app.stop()
+            await post_shutdown(app)
+
+async def _run_single_webhook():
+    app = build_application(webhook=True)
+    incoming = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+
+    async def dispatch(data):
+        try:
+            incoming.put_nowait(data)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def queue_depth():
+        in_app = app.update_queue.qsize() + app.update_processor.current_concurrent_updates
+        return {"workers": 1, "queue_depth": [incoming.qsize() + in_app]}
+
+    async def serve():
+        try:
+            await serve_webhook(dispatch, queue_depth)
+        finally:
+            await incoming.put(None)
+
+    server = asyncio.create_task(serve())
+    await set_webhook(app.bot)
+    await run_application(app, incoming.get)
+    await server
+
+def run_webhook_worker(index, queue):
+    """Proceso worker: atiende solo los chats que el front le asigna (chat_id % workers)."""
+    global DATA_DIR, METRICS_PORT
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s - worker {index} - %(levelname)s - %(message)s')
+    # El front se encarga de las señales y nos para con un None en la cola
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Cada worker tiene sus propios ficheros de estado: sus atletas siempre llegan a él
+    DATA_DIR = os.path.join(DATA_DIR, f"worker-{index}")
+    # y su propio puerto de métricas (puerto base + índice)
+    if METRICS_PORT:
+        METRICS_PORT += index
+    init_bot_state()
+    app = build_application(webhook=True)
+
+    async def next_update():
+        return await asyncio.get_running_loop().run_in_executor(None, queue.get)
+
+    asyncio.run(run_application(app, next_update))
+
+async def _run_webhook_front(queues):
+    async def dispatch(data):
+        # Todos los updates de un chat van al mismo worker y mantienen su orden
+        try:
+            queues[update_chat_id(data) % len(queues)].put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    def queue_depth():
+        return {"workers": len(queues), "queue_depth": [q.qsize() for q in queues]}
+
+    bot = Bot(BOT_TOKEN)
+    async with bot:
+        await set_webhook(bot)
+    await serve_webhook(dispatch, queue_depth)
+
+def run_webhook():
+    if not WEBHOOK_SECRET:
+        raise SystemExit("El modo webhook necesita BOT_WEBHOOK_SECRET: sin él se aceptaría cualquier update que llegue al puerto.")
+
+    if WEBHOOK_WORKERS <= 1:
+        init_bot_state()
+        asyncio.run(_run_single_webhook())
+        return
+
+    # Procesos nuevos (spawn): cada worker crea sus propios clientes de Google
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(WEBHOOK_WORKERS)]
+    workers = [mp.Process(target=run_webhook_worker, args=(i, q), name=f"bot-worker-{i}") for i, q in enumerate(queues)]
+    for worker in workers:
+        worker.start()
+    try:
+        asyncio.run(_run_webhook_front(queues))
+    finally:
+        for q in queues:
+            q.put(None)
+        for worker in workers:
+            worker.join()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if sys.argv[1:] == ["migrar-revisiones"]:
+        migrated = migrate_revisions_to_wide()
+        logging.info(f"✅ {migrated} revisiones migradas a la pestaña {WIDE_REVISION_WORKSHEET_NAME}.")
+        return
+
+    if not BOT_TOKEN:
+        raise SystemExit("Falta BOT_TOKEN: define la variable de entorno con el token de @BotFather.")
+
+    if BOT_MODE == "webhook":
+        run_webhook()
+        return
+
+    init_bot_state()
+    app = build_application()
+
     logging.info("✅ Bot iniciado correctamente.")
 
     app.run_polling()
 
 if __name__ == '__main__':
-    # Las preguntas deben cargarse antes de lanzar el bot
-    Questions = readQuestions()
     #schedule_monthly_tasks()
     main()
-
-
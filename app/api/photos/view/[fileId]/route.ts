@@ -1,6 +1,6 @@
 import { NextResponse } from "next/server";
 import { requireSession } from "@/lib/auth/require-session";
-import { canUserAccessPhotoFile, downloadDriveFile } from "@/lib/google/drive";
+import { canUserAccessPhotoFile, downloadDriveFile, resolveFullSizePhotoId } from "@/lib/google/drive";
 import { listRevisionRowsForUser } from "@/lib/google/sheets";
 import { logError } from "@/lib/logger";
 
@@ -37,7 +37,7 @@ async function isFileReferencedInUserRevisions(username: string, fileId: string)
   });
 }
 
-export async function GET(_req: Request, context: RouteContext) {
+export async function GET(req: Request, context: RouteContext) {
   const auth = await requireSession();
   if (!auth.session) return auth.response;
 
@@ -63,7 +63,8 @@ export async function GET(_req: Request, context: RouteContext) {
       }
     }
 
-    const file = await downloadDriveFile(fileId);
+    const fullSize = new URL(req.url).searchParams.get("size") === "full";
+    const file = await downloadDriveFile(fullSize ? await resolveFullSizePhotoId(fileId) : fileId);
     const fileName = sanitizeFileName(file.name);
 
     return new NextResponse(new Uint8Array(file.data), {
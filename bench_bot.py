@@ -0,0 +1,512 @@
+"""Banco de pruebas de carga del bot de revisiones (ScriptBot.py) sin red.
+
+Ejecuta los handlers reales con updates sintéticos contra dobles en proceso
+de la Bot API, gspread y Drive que simulan latencia y errores de cuota (429):
+
+  * cuestionario: N atletas completan la revisión a la vez (/revision + respuestas)
+  * álbumes: N atletas envían sus 4 fotos como álbum tras /fotos
+  * envío semanal: el cuestionario del domingo a todos los atletas
+
+Mide throughput, latencias p50/p99 por handler y llamadas a la API por
+revisión completada, y guarda el resultado en JSON para comparar entre cambios:
+
+    python bench_bot.py --users 200 --sheets-latency 0.15 --quota-error-rate 0.02
+    python bench_bot.py --users 200 --compare bench_results/anterior.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+
+import httplib2
+import requests
+from googleapiclient.errors import HttpError
+from gspread.exceptions import APIError
+from gspread.utils import a1_to_rowcol
+from PIL import Image
+from telegram.error import RetryAfter
+
+import ScriptBot as bot
+
+
+class FakeBackend:
+    """Latencia, errores 429 y contadores compartidos por todos los dobles."""
+
+    def __init__(self, sheets_latency, drive_latency, telegram_latency, quota_error_rate, flood_error_rate, seed):
+        self.sheets_latency = sheets_latency
+        self.drive_latency = drive_latency
+        self.telegram_latency = telegram_latency
+        self.quota_error_rate = quota_error_rate
+        self.flood_error_rate = flood_error_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _jitter(self, latency):
+        with self._lock:
+            return latency * self._random.uniform(0.5, 1.5)
+
+    def _fail(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def google_call(self, op, latency):
+        """Cuenta y simula una llamada bloqueante (se ejecuta en los hilos del pool)."""
+        with self._lock:
+            self.calls[op] += 1
+        time.sleep(self._jitter(latency))
+        if self._fail(self.quota_error_rate):
+            with self._lock:
+                self.errors[op] += 1
+            if op.startswith("sheets."):
+                response = requests.Response()
+                response.status_code = 429
+                response._content = json.dumps({"error": {
+                    "code": 429, "message": "Quota exceeded (simulado)", "status": "RESOURCE_EXHAUSTED"
+                }}).encode()
+                raise APIError(response)
+            raise HttpError(httplib2.Response({"status": 429}), b'{"error": {"code": 429}}')
+
+    async def telegram_call(self, op):
+        with self._lock:
+            self.calls[op] += 1
+        await asyncio.sleep(self._jitter(self.telegram_latency))
+        if op == "telegram.send_message" and self._fail(self.flood_error_rate):
+            with self._lock:
+                self.errors[op] += 1
+            raise RetryAfter(1)
+
+
+class FakeWorksheet:
+    def __init__(self, backend, name, values=None, records=None):
+        self.backend = backend
+        self.name = name
+        self.values = values or []
+        self.records = records or []
+        self.id = 0
+        self.spreadsheet = SimpleNamespace(id=f"sheet-{name}", batch_update=self._batch_update)
+
+    def _batch_update(self, body):
+        # gspread_formatting (congelar la cabecera) pasa por aquí
+        self.backend.google_call("sheets.batch_update", self.backend.sheets_latency)
+        return {}
+
+    def col_values(self, col):
+        self.backend.google_call("sheets.col_values", self.backend.sheets_latency)
+        return [row[col - 1] for row in self.values if len(row) >= col]
+
+    def get_all_records(self):
+        self.backend.google_call("sheets.get_all_records", self.backend.sheets_latency)
+        return list(self.records)
+
+    def row_values(self, row):
+        self.backend.google_call("sheets.row_values", self.backend.sheets_latency)
+        return list(self.values[row - 1]) if len(self.values) >= row else []
+
+    @property
+    def col_count(self):
+        return max([26] + [len(r) for r in self.values])
+
+    def add_cols(self, cols):
+        pass
+
+    def get(self, range_name, value_render_option=None):
+        self.backend.google_call("sheets.get", self.backend.sheets_latency)
+        first, _, last = range_name.partition(":")
+        first_row = int(re.sub(r"[A-Z]", "", first))
+        last_row = int(re.sub(r"[A-Z]", "", last) or len(self.values))
+        first_col = ord(first[0]) - ord("A") if first[0].isalpha() else 0
+        last_col = ord(last[0]) - ord("A") + 1 if last and last[0].isalpha() else None
+        return [list(r[first_col:last_col]) for r in self.values[first_row - 1:last_row]]
+
+    def update(self, values, range_name):
+        # Solo se usa para reescribir la cabecera
+        self.backend.google_call("sheets.update", self.backend.sheets_latency)
+        if self.values:
+            self.values[0] = list(values[0])
+        else:
+            self.values.append(list(values[0]))
+
+    def batch_update(self, data, value_input_option="RAW"):
+        # Los enlaces de las fotos sobre la fila de su revisión (formato ancho)
+        self.backend.google_call("sheets.batch_update", self.backend.sheets_latency)
+        for item in data:
+            row, col = a1_to_rowcol(item["range"])
+            values = self.values[row - 1]
+            values.extend([""] * (col - len(values)))
+            values[col - 1] = item["values"][0][0]
+
+    def cells(self):
+        return sum(len(r) for r in self.values)
+
+    def clear(self):
+        self.backend.google_call("sheets.clear", self.backend.sheets_latency)
+        self.values = []
+
+    def append_row(self, row, value_input_option="RAW"):
+        self.append_rows([row], value_input_option)
+
+    def append_rows(self, rows, value_input_option="RAW", table_range=None):
+        self.backend.google_call("sheets.append_rows", self.backend.sheets_latency)
+        self.values.extend(list(r) for r in rows)
+
+    def freeze(self, rows=None, cols=None):
+        pass
+
+
+class FakeRequest:
+    def __init__(self, backend, op, result):
+        self.backend = backend
+        self.op = op
+        self.result = result
+
+    def execute(self):
+        self.backend.google_call(self.op, self.backend.drive_latency)
+        return self.result() if callable(self.result) else self.result
+
+    def next_chunk(self):
+        # Subida reanudable simulada de un solo trozo
+        return None, self.execute()
+
+
+class FakeBatch:
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request):
+        self.requests.append(request)
+
+    def execute(self):
+        # Un lote es una sola petición HTTP, sea cual sea su tamaño
+        self.backend.google_call("drive.batch", self.backend.drive_latency)
+        for index, request in enumerate(self.requests):
+            result = request.result() if callable(request.result) else request.result
+            self.callback(str(index), result, None)
+
+
+class FakeDrive:
+    """Lo justo de la API de Drive v3 que usa el bot."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.folders = []
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _new_id(self, prefix):
+        with self._lock:
+            self._next_id += 1
+            return f"{prefix}{self._next_id}"
+
+    def files(self):
+        return self
+
+    def permissions(self):
+        return SimpleNamespace(create=lambda fileId, body: FakeRequest(self.backend, "drive.permissions.create", {"id": "perm"}))
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self.backend, callback)
+
+    def list(self, q, fields=None, pageSize=None, pageToken=None):
+        parent = re.search(r"'([^']+)' in parents", q).group(1)
+        name_match = re.search(r"name = '((?:[^'\\]|\\.)*)'", q)
+        name = re.sub(r"\\(.)", r"\1", name_match.group(1)) if name_match else None
+
+        def result():
+            with self._lock:
+                files = [f for f in self.folders if f["parent"] == parent and (name is None or f["name"] == name)]
+            return {"files": [{"id": f["id"], "name": f["name"]} for f in files]}
+        return FakeRequest(self.backend, "drive.files.list", result)
+
+    def create(self, body, media_body=None, fields=None):
+        def result():
+            file_id = self._new_id("file")
+            if body.get("mimeType") == bot.FOLDER_MIME_TYPE:
+                with self._lock:
+                    self.folders.append({"id": file_id, "name": body["name"], "parent": body["parents"][0]})
+            return {"id": file_id, "webContentLink": f"https://drive.example/{file_id}"}
+        return FakeRequest(self.backend, "drive.files.create", result)
+
+    def get(self, fileId, fields=None):
+        return FakeRequest(self.backend, "drive.files.get", {"modifiedTime": "2026-01-01T00:00:00.000Z"})
+
+
+class FakeGoogleClients:
+    def __init__(self, backend, users, questions):
+        self.users_ws = FakeWorksheet(backend, "Users", records=[{"Nombre": n, "Usuario": u} for n, u in users])
+        self.questions_ws = FakeWorksheet(backend, "Preguntas", values=[[q] for q in questions])
+        self.revision_ws = FakeWorksheet(backend, "Revisiones")
+        self.wide_revision_ws = FakeWorksheet(backend, "RevisionPorFila")
+        self.drive = FakeDrive(backend)
+
+    def current_revision_ws(self):
+        return self.wide_revision_ws if bot.REVISION_FORMAT == "wide" else self.revision_ws
+
+
+class FakeTelegramFile:
+    def __init__(self, backend, data):
+        self.backend = backend
+        self.data = data
+
+    async def download_as_bytearray(self):
+        await self.backend.telegram_call("telegram.download")
+        return bytearray(self.data)
+
+
+class FakeBot:
+    def __init__(self, backend, photo_bytes):
+        self.backend = backend
+        self.photo_bytes = photo_bytes
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.backend.telegram_call("telegram.send_message")
+
+    async def get_file(self, file_id):
+        await self.backend.telegram_call("telegram.get_file")
+        # Bytes distintos por foto (tras el fin del JPEG) para que no cuenten como repetidas
+        return FakeTelegramFile(self.backend, self.photo_bytes + file_id.encode())
+
+
+class FakeApplication:
+    def __init__(self):
+        self.update_queue = asyncio.Queue()
+        self.bot_data = {}
+
+    def create_task(self, coroutine, update=None):
+        return asyncio.ensure_future(coroutine)
+
+
+class Recorder:
+    """Latencias exactas por handler medidas desde fuera."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = Counter()
+
+    async def run(self, name, coroutine):
+        start = time.perf_counter()
+        try:
+            return await coroutine
+        except Exception:
+            self.errors[name] += 1
+        finally:
+            self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        result = {}
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            result[name] = {
+                "count": len(values),
+                "errors": self.errors[name],
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+            }
+        return result
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def make_update(username, chat_id, text=None, photo=None, media_group_id=None):
+    """Update sintético con los campos que leen los handlers."""
+    user = SimpleNamespace(name=f"@{username}", username=username, full_name=username.capitalize())
+    chat = SimpleNamespace(id=chat_id, type="private")
+
+    async def reply_text(text, **kwargs):
+        await bot_double.send_message(chat_id, text)
+
+    message = SimpleNamespace(
+        from_user=user, chat_id=chat_id, text=text, photo=photo,
+        media_group_id=media_group_id, reply_text=reply_text
+    )
+    return SimpleNamespace(message=message, effective_chat=chat, effective_user=user)
+
+
+def sample_photo():
+    image = Image.new("RGB", (1280, 960))
+    pixels = image.load()
+    for x in range(0, 1280, 8):
+        for y in range(0, 960, 8):
+            pixels[x, y] = (x % 256, y % 256, (x + y) % 256)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+async def drain_journal():
+    # Lo que el flusher periódico haría: volcar hasta que no quede nada
+    while bot.revision_journal.pending_rows():
+        try:
+            await bot.flush_journal_job(None)
+        except Exception:
+            pass
+        if bot.revision_journal.pending_rows():
+            await asyncio.sleep(0.05)
+
+
+async def scenario_questionnaire(users, context, recorder):
+    async def athlete(index, username):
+        await recorder.run("revision_command", bot.revision_command(make_update(username, index, "/revision"), context))
+        questions = bot.question_catalog.current.questions
+        for answer_index in range(len(questions) - 1):
+            await recorder.run("handle_text", bot.handle_text(make_update(username, index, f"{80 + answer_index}"), context))
+        await recorder.run("handle_text", bot.handle_text(make_update(username, index, "NO"), context))
+
+    await asyncio.gather(*(athlete(i, u) for i, (_, u) in enumerate(users)))
+
+
+async def scenario_albums(users, context, recorder):
+    async def athlete(index, username):
+        await recorder.run("fotos_command", bot.fotos_command(make_update(username, index, "/fotos"), context))
+        start = time.perf_counter()
+        album_id = f"album-{index}"
+        for position in range(4):
+            photo = [SimpleNamespace(file_id=f"{username}-{position}", file_unique_id=f"u-{username}-{position}",
+                                     width=1280, height=960)]
+            await recorder.run("handle_photo", bot.handle_photo(
+                make_update(username, index, photo=photo, media_group_id=album_id), context))
+        task = bot.pending_albums[album_id]["task"]
+        await recorder.run("album_end_to_end", asyncio.shield(task))
+        recorder.latencies["album_end_to_end"][-1] = time.perf_counter() - start
+
+    await asyncio.gather(*(athlete(i, u) for i, (_, u) in enumerate(users)))
+
+
+async def scenario_broadcast(users, context, recorder):
+    for index, (_, username) in enumerate(users):
+        bot.known_chats.record(f"@{username}", index)
+    return await recorder.run("broadcast", bot.send_questions_to_all_users(context))
+
+
+async def run_benchmark(args):
+    global bot_double
+    backend = FakeBackend(args.sheets_latency, args.drive_latency, args.telegram_latency,
+                          args.quota_error_rate, args.flood_error_rate, args.seed)
+    users = [(f"Atleta {i}", f"atleta{i}") for i in range(args.users)]
+    questions = [f"Perímetro {i + 1} (cm)" for i in range(args.questions)]
+
+    data_dir = tempfile.mkdtemp(prefix="bench-bot-")
+    bot.DATA_DIR = data_dir
+    bot.ALBUM_WAIT_SECONDS = args.album_wait
+    bot.BROADCAST_WINDOW_SECONDS = args.broadcast_window
+    bot.REVISION_FORMAT = args.revision_format
+    bot.google_clients = FakeGoogleClients(backend, [(n, f"@{u}") for n, u in users], questions)
+    bot.google_io = bot.GoogleIO()
+    bot.init_bot_state()
+
+    bot_double = FakeBot(backend, sample_photo())
+    # Arrancar los procesos del pool de imágenes fuera de las mediciones
+    await bot.process_image(bot_double.photo_bytes)
+    context = SimpleNamespace(bot=bot_double, application=FakeApplication())
+
+    results = {}
+    for name, scenario in (("questionnaire", scenario_questionnaire),
+                           ("albums", scenario_albums),
+                           ("broadcast", scenario_broadcast)):
+        if name not in args.scenarios:
+            continue
+        backend.calls.clear()
+        backend.errors.clear()
+        recorder = Recorder()
+        start = time.perf_counter()
+        outcome = await scenario(users, context, recorder)
+        await drain_journal()
+        elapsed = time.perf_counter() - start
+
+        google_calls = {op: n for op, n in backend.calls.items() if not op.startswith("telegram.")}
+        completed = args.users
+        results[name] = {
+            "seconds": round(elapsed, 3),
+            "throughput_per_s": round(completed / elapsed, 2) if elapsed else None,
+            "handlers": recorder.summary(),
+            "api_calls": dict(sorted(backend.calls.items())),
+            "api_errors": dict(sorted(backend.errors.items())),
+            "google_calls_per_revision": round(sum(google_calls.values()) / completed, 2),
+            "sheet_cells": bot.google_clients.current_revision_ws().cells(),
+        }
+        if isinstance(outcome, dict):
+            results[name]["outcome"] = outcome
+
+    bot.revision_journal.close()
+    bot.sessions.close()
+    bot.google_io.shutdown()
+    if bot.image_pool is not None:
+        bot.image_pool.shutdown()
+    return results
+
+
+def print_report(report, previous=None):
+    for name, result in report["results"].items():
+        print(f"\n== {name}: {result['seconds']} s · {result['throughput_per_s']} atletas/s · "
+              f"{result['google_calls_per_revision']} llamadas Google por revisión · {result['sheet_cells']} celdas en la hoja")
+        before = (previous or {}).get("results", {}).get(name)
+        for handler, stats in result["handlers"].items():
+            line = f"   {handler:<18} n={stats['count']:<5} p50={stats['p50_ms']:>9} ms  p99={stats['p99_ms']:>9} ms  errores={stats['errors']}"
+            old = before and before["handlers"].get(handler)
+            if old:
+                line += f"  (antes p50={old['p50_ms']} ms, p99={old['p99_ms']} ms)"
+            print(line)
+        if before:
+            print(f"   antes: {before['seconds']} s · {before['google_calls_per_revision']} llamadas Google por revisión")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--questions", type=int, default=15)
+    parser.add_argument("--scenarios", nargs="+", default=["questionnaire", "albums", "broadcast"])
+    parser.add_argument("--sheets-latency", type=float, default=0.15, help="segundos por llamada a Sheets")
+    parser.add_argument("--drive-latency", type=float, default=0.2, help="segundos por llamada a Drive")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="segundos por llamada a Telegram")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="probabilidad de 429 en Google")
+    parser.add_argument("--flood-error-rate", type=float, default=0.0, help="probabilidad de RetryAfter en Telegram")
+    parser.add_argument("--album-wait", type=float, default=0.2)
+    parser.add_argument("--broadcast-window", type=float, default=5.0)
+    parser.add_argument("--revision-format", choices=["long", "wide"], default="long")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="fichero JSON de resultados (por defecto bench_results/<fecha>.json)")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior con el que comparar")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+    print_report(report, previous)
+
+    output = args.output or os.path.join("bench_results", datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados guardados en {output}")
+
+
+bot_double = None
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,7 @@ type RevisionEntry = {
   pregunta: string;
   respuesta: string;
   imageUrl: string | null;
+  fullImageUrl: string | null;
 };
 
 type RoutineLog = {
@@ -804,7 +805,7 @@ export function AdminShell({ user }: AdminShellProps) {
                             {imageItems.length ? (
                               <div className="grid grid-cols-2 gap-2 md:grid-cols-4">
                                 {imageItems.map((item, index) => (
-                                  <a key={`${date}-img-${index}`} href={item.imageUrl ?? "#"} target="_blank" rel="noreferrer" className="overflow-hidden rounded-lg border border-white/15">
+                                  <a key={`${date}-img-${index}`} href={item.fullImageUrl ?? item.imageUrl ?? "#"} target="_blank" rel="noreferrer" className="overflow-hidden rounded-lg border border-white/15">
                                     <img src={item.imageUrl ?? ""} alt={item.pregunta} className="h-24 w-full object-cover" />
                                   </a>
                                 ))}
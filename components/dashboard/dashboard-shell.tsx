@@ -59,6 +59,7 @@ type RevisionEntry = {
   pregunta: string;
   respuesta: string;
   imageUrl: string | null;
+  fullImageUrl: string | null;
 };
 
 type RevisionDraft = Record<string, string>;
@@ -2179,7 +2180,7 @@ export function DashboardShell({ user }: DashboardShellProps) {
                           <button
                             key={`${selectedRevisionDate}-img-${itemIndex}`}
                             type="button"
-                            onClick={() => setLightboxImage(item.imageUrl)}
+                            onClick={() => setLightboxImage(item.fullImageUrl ?? item.imageUrl)}
                             className="overflow-hidden rounded-lg border border-white/15"
                           >
                             <img
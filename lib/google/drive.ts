@@ -416,6 +416,13 @@ export async function downloadDriveFile(fileId: string): Promise<{
   };
 }
 
+export async function resolveFullSizePhotoId(fileId: string): Promise<string> {
+  const drive = await getDriveReadOnlyClient();
+  const file = await drive.files.get({ fileId, fields: "appProperties", supportsAllDrives: true });
+  const fullFileId = file.data.appProperties?.fullFileId ?? "";
+  return /^[A-Za-z0-9_-]{10,}$/.test(fullFileId) ? fullFileId : fileId;
+}
+
 export async function getDriveFileThumbnail(fileId: string): Promise<{
   data: Buffer;
   mimeType: string;
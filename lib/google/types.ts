@@ -14,4 +14,5 @@ export type RevisionRow = {
 
 export type RevisionEntry = RevisionRow & {
   imageUrl: string | null;
+  fullImageUrl: string | null;
 };
@@ -20,6 +20,11 @@ export function extractImageUrl(value: string | undefined | null): string | null
   return null;
 }
 
+export function toFullSizeImageUrl(imageUrl: string | null): string | null {
+  if (!imageUrl?.startsWith("/api/photos/view/")) return imageUrl;
+  return `${imageUrl}?size=full`;
+}
+
 function sanitizeUrl(url: string): string {
   return url.replace(/[)"';]+$/, "");
 }
@@ -1,4 +1,4 @@
-import { extractImageUrl } from "@/lib/parse-image-formula";
+import { extractImageUrl, toFullSizeImageUrl } from "@/lib/parse-image-formula";
 import type { RevisionEntry, RevisionRow } from "@/lib/google/types";
 
 export function buildRevisionRows(input: {
@@ -20,6 +20,7 @@ export function toRevisionEntry(row: RevisionRow): RevisionEntry {
   const imageUrl = extractImageUrl(row.respuesta);
   return {
     ...row,
-    imageUrl
+    imageUrl,
+    fullImageUrl: toFullSizeImageUrl(imageUrl)
   };
 }
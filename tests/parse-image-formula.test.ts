@@ -1,5 +1,5 @@
 import { describe, expect, it } from "vitest";
-import { extractImageUrl } from "@/lib/parse-image-formula";
+import { extractImageUrl, toFullSizeImageUrl } from "@/lib/parse-image-formula";
 
 describe("extractImageUrl", () => {
   it("extracts from IMAGE formula with valid drive id and maps to local view endpoint", () => {
@@ -26,3 +26,16 @@ describe("extractImageUrl", () => {
     expect(extractImageUrl("sin enlace")).toBeNull();
   });
 });
+
+describe("toFullSizeImageUrl", () => {
+  it("asks the local view endpoint for the full-size file", () => {
+    expect(toFullSizeImageUrl("/api/photos/view/1aUQq2TmlgcnrWlTpDGEGyr5qSpYTRLIO")).toBe(
+      "/api/photos/view/1aUQq2TmlgcnrWlTpDGEGyr5qSpYTRLIO?size=full"
+    );
+  });
+
+  it("keeps external urls and missing images as they are", () => {
+    expect(toFullSizeImageUrl("https://example.com/file.jpg")).toBe("https://example.com/file.jpg");
+    expect(toFullSizeImageUrl(null)).toBeNull();
+  });
+});
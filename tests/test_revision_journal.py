@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+from ScriptBot import RevisionJournal
+
+
+class FakeSheet:
+    def __init__(self, fail_on_call=None):
+        self.calls = []
+        self.fail_on_call = fail_on_call
+
+    def append_rows(self, rows, value_input_option="RAW"):
+        if len(self.calls) == self.fail_on_call:
+            raise RuntimeError("429")
+        self.calls.append((list(rows), value_input_option))
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "revisiones.jsonl")
+
+
+def pending(journal):
+    return [entry["rows"] for _, entry in journal._pending]
+
+
+def test_torn_write_is_truncated_on_replay(path):
+    journal = RevisionJournal(path)
+    journal.append([["Ana", "2026-06-01", "@ana", "Peso (kg)", "60"]])
+    journal.close()
+    complete = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(b'{"ts": 1, "opt": "RAW", "rows": [["Be')
+
+    journal = RevisionJournal(path)
+    assert os.path.getsize(path) == complete
+    journal.append([["Bea", "2026-06-01", "@bea", "Peso (kg)", "55"]])
+    journal.close()
+
+    # Los arranques siguientes leen las dos entradas sin restos de la escritura cortada
+    journal = RevisionJournal(path)
+    assert pending(journal) == [
+        [["Ana", "2026-06-01", "@ana", "Peso (kg)", "60"]],
+        [["Bea", "2026-06-01", "@bea", "Peso (kg)", "55"]],
+    ]
+    journal.close()
+
+
+def test_unreadable_line_does_not_stop_startup(path):
+    with open(path, "wb") as f:
+        f.write(b"no es json\n")
+        f.write(b'{"ts": 1, "opt": "RAW", "rows": [["Ana"]]}\n')
+
+    journal = RevisionJournal(path)
+    assert pending(journal) == [[["Ana"]]]
+    journal.close()
+
+
+def test_flush_advances_offset_after_each_write(path):
+    journal = RevisionJournal(path)
+    journal.append([["Ana"]])
+    journal.append([["=IMAGE(\"x\")"]], value_input_option="USER_ENTERED")
+
+    # La segunda escritura falla: la primera no debe volver a enviarse
+    sheet = FakeSheet(fail_on_call=1)
+    with pytest.raises(RuntimeError):
+        journal.flush(sheet)
+    assert sheet.calls == [([["Ana"]], "RAW")]
+    journal.close()
+
+    journal = RevisionJournal(path)
+    assert pending(journal) == [[["=IMAGE(\"x\")"]]]
+    sheet = FakeSheet()
+    assert journal.flush(sheet) == 1
+    assert sheet.calls == [([["=IMAGE(\"x\")"]], "USER_ENTERED")]
+    journal.close()
+
+    journal = RevisionJournal(path)
+    assert pending(journal) == []
+    journal.close()
+
+
+def test_compact_empties_the_file_once_everything_is_written(path):
+    journal = RevisionJournal(path)
+    journal.append([["x" * (1024 * 1024)]])
+    assert journal.flush(FakeSheet()) == 1
+    assert os.path.getsize(path) == 0
+    assert journal._read_offset() == 0
+
+    # Tras compactar, el diario sigue funcionando desde el principio del fichero
+    journal.append([["Ana"]])
+    journal.close()
+    journal = RevisionJournal(path)
+    assert pending(journal) == [[["Ana"]]]
+    journal.close()
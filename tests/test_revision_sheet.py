@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+
+from ScriptBot import RevisionJournal, RevisionSheet, photo_links_patch
+
+
+class FakeWorksheet:
+    def __init__(self, failures=0):
+        self.values = []
+        self.col_count = 26
+        self.failures = failures
+
+    def row_values(self, row):
+        return list(self.values[row - 1]) if len(self.values) >= row else []
+
+    def col_values(self, col):
+        return [row[col - 1] if len(row) >= col else "" for row in self.values]
+
+    def add_cols(self, cols):
+        self.col_count += cols
+
+    def update(self, values, range_name):
+        if self.values:
+            self.values[0] = list(values[0])
+        else:
+            self.values.append(list(values[0]))
+
+    def append_rows(self, rows, value_input_option="RAW", table_range=None):
+        self.values.extend(list(r) for r in rows)
+
+    def batch_update(self, data, value_input_option="RAW"):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("503")
+        header = self.values[0]
+        for item in data:
+            col = "ABCDEFGHIJKLMNOPQRSTUVWXYZ".index(item["range"][0])
+            row = self.values[int(item["range"][1:]) - 1]
+            row.extend([""] * (len(header) - len(row)))
+            row[col] = item["values"][0][0]
+
+
+def record(revision_id):
+    return {"Revision": revision_id, "Nombre": "Ana", "Fecha": "2026-06-01", "Telegram": "@ana", "peso_kg": "60"}
+
+
+def test_failed_photo_update_does_not_duplicate_rows(tmp_path):
+    ws = FakeWorksheet(failures=1)
+    sheet = RevisionSheet(SimpleNamespace(wide_revision_ws=ws))
+    journal = RevisionJournal(str(tmp_path / "revisiones.jsonl"))
+    journal.append([record("r1")])
+    journal.flush(sheet)
+
+    journal.append([photo_links_patch("r1", ["https://x/1"])])
+    journal.append([record("r2")])
+    with pytest.raises(RuntimeError):
+        journal.flush(sheet)
+    journal.flush(sheet)
+
+    assert [row[0] for row in ws.values] == ["Revision", "r1", "r2"]
+    assert ws.values[1][ws.values[0].index("foto_1")] == "https://x/1"
+    journal.close()
+
+
+def test_photos_in_the_same_batch_join_their_revision(tmp_path):
+    ws = FakeWorksheet()
+    sheet = RevisionSheet(SimpleNamespace(wide_revision_ws=ws))
+    sheet.append_rows([record("r1"), photo_links_patch("r1", ["https://x/1", "https://x/2"])])
+
+    header = ws.values[0]
+    assert len(ws.values) == 2
+    assert ws.values[1][header.index("foto_2")] == "https://x/2"